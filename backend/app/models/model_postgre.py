@@ -15,6 +15,10 @@ from sqlalchemy.dialects.postgresql import ARRAY
 from ..services.postgre_client import Base
 
 
+# mongo_id giữ dạng hex String(24) thay vì BYTEA 12 byte: chuỗi hex đi thẳng
+# vào JSON debug/response và Cypher của Neo4j, còn chi phí parse lặp lại phía
+# search đã được memoize (xem _oid bên user_semantic_search).
+
 # ===== 1) CLASS =====
 class Class(Base):
     __tablename__ = "class"
@@ -72,6 +76,9 @@ class Keyword(Base):
     __tablename__ = "keyword"
     keyword_id = Column(String, primary_key=True)  # VARCHAR(96)
     keyword_name = Column(Text, nullable=False)
+    # REAL[] (không phải JSON/TEXT): driver trả thẳng list float, không có
+    # bước parse JSON. Không chuyển bytea float32 vì embedding còn sync sang
+    # Neo4j và trả ra debug payload dưới dạng list.
     keyword_embedding = Column(ARRAY(Float), nullable=True)
     mongo_id = Column(String(24), unique=True, nullable=True)
 
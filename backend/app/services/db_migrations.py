@@ -87,7 +87,48 @@ def ensure_hierarchy_number_columns() -> None:
         return
 
 
+def ensure_chunk_content_hash_column() -> None:
+    """Ensure PostgreSQL table 'chunk' has column content_hash (skip no-op re-syncs)."""
+    engine = get_engine()
+    try:
+        with engine.begin() as conn:
+            if not _table_exists(conn, "chunk"):
+                return
+            if _column_exists(conn, "chunk", "content_hash"):
+                return
+            conn.execute(text("ALTER TABLE chunk ADD COLUMN content_hash VARCHAR(32)"))
+    except Exception:
+        return
+
+
+def ensure_mongo_id_lookup_indexes() -> None:
+    """Ensure covering indexes on mongo_id so sync PK lookups are index-only scans."""
+    engine = get_engine()
+    specs = [
+        ("class", "idx_class_mongo_id", "class_id"),
+        ("subject", "idx_subject_mongo_id", "subject_id"),
+        ("topic", "idx_topic_mongo_id", "topic_id"),
+        ("lesson", "idx_lesson_mongo_id", "lesson_id"),
+        ("chunk", "idx_chunk_mongo_id", "chunk_id, content_hash"),
+    ]
+    try:
+        with engine.begin() as conn:
+            for table_name, index_name, include_cols in specs:
+                if not _table_exists(conn, table_name):
+                    continue
+                conn.execute(
+                    text(
+                        f"CREATE INDEX IF NOT EXISTS {index_name} "
+                        f"ON {table_name}(mongo_id) INCLUDE ({include_cols})"
+                    )
+                )
+    except Exception:
+        return
+
+
 def ensure_postgre_search_columns() -> None:
     ensure_keyword_map_id_column()
     ensure_keyword_embedding_column()
     ensure_hierarchy_number_columns()
+    ensure_chunk_content_hash_column()
+    ensure_mongo_id_lookup_indexes()
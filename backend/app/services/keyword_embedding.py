@@ -31,6 +31,8 @@ class Embedder(Protocol):
 
     def embed(self, text: str, *, mode: EmbedMode = "passage") -> List[float]: ...
 
+    def embed_many(self, texts: List[str], *, mode: EmbedMode = "passage") -> List[List[float]]: ...
+
 
 def _clean(s: str | None) -> str:
     return "" if s is None else str(s).strip()
@@ -81,7 +83,7 @@ class HashEmbedder:
         for t in tokens:
             self._acc(vec, t.encode("utf-8"), weight=1.0)
 
-        compact = re.sub(r"\s+", " ", low).strip()
+        compact = " ".join(low.split())
         if len(compact) >= 3:
             for i in range(len(compact) - 2):
                 gram = compact[i : i + 3]
@@ -89,6 +91,10 @@ class HashEmbedder:
 
         return _normalize(vec)
 
+    def embed_many(self, texts: List[str], *, mode: EmbedMode = "passage") -> List[List[float]]:
+        # hash embedder tính local, không có RTT để gom
+        return [self.embed(t, mode=mode) for t in texts]
+
 
 @dataclass(frozen=True)
 class OpenAIEmbedder:
@@ -114,6 +120,26 @@ class OpenAIEmbedder:
         emb = list(res.data[0].embedding)
         return _normalize([float(x) for x in emb])
 
+    def embed_many(self, texts: List[str], *, mode: EmbedMode = "passage") -> List[List[float]]:
+        cleaned = [_clean(t) for t in texts]
+        nonempty = [t for t in cleaned if t]
+        if not nonempty:
+            return [[0.0] * self.dim for _ in cleaned]
+
+        try:
+            from openai import OpenAI  # type: ignore
+        except Exception as e:
+            raise RuntimeError(
+                "OpenAI provider selected but `openai` package is not installed. Run: pip install openai"
+            ) from e
+
+        prefix = "query: " if mode == "query" else "passage: "
+        client = OpenAI()
+        # API nhận list input => 1 RTT cho cả lô
+        res = client.embeddings.create(model=self.model, input=[f"{prefix}{t}" for t in nonempty])
+        vecs = iter(_normalize([float(x) for x in item.embedding]) for item in res.data)
+        return [next(vecs) if t else [0.0] * self.dim for t in cleaned]
+
 
 @dataclass(frozen=True)
 class SentenceTransformerEmbedder:
@@ -143,6 +169,31 @@ class SentenceTransformerEmbedder:
         )
         return [float(x) for x in vec.tolist()]
 
+    def embed_many(self, texts: List[str], *, mode: EmbedMode = "passage") -> List[List[float]]:
+        cleaned = [_clean(t) for t in texts]
+        nonempty = [t for t in cleaned if t]
+        if not nonempty:
+            return [[0.0] * self.dim for _ in cleaned]
+
+        try:
+            from sentence_transformers import SentenceTransformer  # type: ignore
+        except Exception as e:
+            raise RuntimeError(
+                "sentence-transformers chưa được cài. Run: pip install sentence-transformers torch"
+            ) from e
+
+        model = _load_sentence_transformer(self.model)
+        prefix = "query: " if mode == "query" else "passage: "
+        # 1 lần encode cho cả lô: model batch hoá forward pass thay vì N lần
+        mat = model.encode(
+            [f"{prefix}{t}" for t in nonempty],
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False,
+        )
+        vecs = iter([float(x) for x in row.tolist()] for row in mat)
+        return [next(vecs) if t else [0.0] * self.dim for t in cleaned]
+
 
 @lru_cache(maxsize=2)
 def _load_sentence_transformer(model_name: str):
@@ -167,16 +218,64 @@ def get_keyword_embedder() -> Embedder:
     return HashEmbedder(dim=dim)
 
 
-@lru_cache(maxsize=4096)
+# Cache dict thay cho lru_cache để đường batch ghi thẳng kết quả vào cache
+# (lru_cache không cho "put" từ ngoài); đầy thì clear cả — pattern như các
+# cache TTL bên sync.
+_EMB_TEXT_CACHE_MAX = 4096
+_emb_text_cache: dict[tuple[str, str], List[float]] = {}
+
+
+def _emb_cache_put(key: tuple[str, str], vec: List[float]) -> None:
+    if len(_emb_text_cache) >= _EMB_TEXT_CACHE_MAX:
+        _emb_text_cache.clear()
+    _emb_text_cache[key] = vec
+
+
 def embed_text_cached(text: str, *, mode: EmbedMode = "passage") -> List[float]:
-    return get_keyword_embedder().embed(text, mode=mode)
+    key = (text, mode)
+    hit = _emb_text_cache.get(key)
+    if hit is not None:
+        return hit
+    vec = get_keyword_embedder().embed(text, mode=mode)
+    _emb_cache_put(key, vec)
+    return vec
+
+
+def embed_texts_batch(texts: List[str], *, mode: EmbedMode = "passage") -> List[List[float]]:
+    """Embed một lô text trong 1 lần gọi provider, đi qua cùng cache với bản lẻ.
+
+    Chỉ những text chưa có trong cache mới vào lô encode; N RTT/forward pass
+    tuần tự gom còn 1.
+    """
+    out: List[List[float]] = [None] * len(texts)  # type: ignore[list-item]
+    missing_idx: List[int] = []
+    missing_texts: List[str] = []
+    pos_by_text: dict[str, int] = {}
+    for i, text in enumerate(texts):
+        hit = _emb_text_cache.get((text, mode))
+        if hit is not None:
+            out[i] = hit
+            continue
+        missing_idx.append(i)
+        if text not in pos_by_text:
+            pos_by_text[text] = len(missing_texts)
+            missing_texts.append(text)
+    if missing_texts:
+        vecs = get_keyword_embedder().embed_many(missing_texts, mode=mode)
+        for text, vec in zip(missing_texts, vecs):
+            _emb_cache_put((text, mode), vec)
+        for i in missing_idx:
+            out[i] = vecs[pos_by_text[texts[i]]]
+    return out
 
 
-@lru_cache(maxsize=4096)
 def embed_keyword_cached(text: str) -> List[float]:
     return embed_text_cached(text, mode="passage")
 
 
-@lru_cache(maxsize=4096)
+def embed_keywords_batch(texts: List[str]) -> List[List[float]]:
+    return embed_texts_batch(texts, mode="passage")
+
+
 def embed_query_cached(text: str) -> List[float]:
     return embed_text_cached(text, mode="query")
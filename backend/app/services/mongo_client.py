@@ -16,19 +16,57 @@ def _load_env():
             load_dotenv(env_path)
             break
 
+# Các field map ID mà sync/search filter theo: thiếu index là COLLSCAN.
+# keywords dùng index ghép (chunkID, keywordID) vì query luôn lọc chunkID
+# rồi sort keywordID.
+_MAP_INDEX_SPECS = [
+    ("classes", "classID"),
+    ("subjects", "subjectID"),
+    ("topics", "topicID"),
+    ("lessons", "lessonID"),
+    ("chunks", "chunkID"),
+    ("keywords", [("chunkID", 1), ("keywordID", 1)]),
+    # search tra isSaved theo (username, chunkID) bằng $in cho cả trang
+    ("user_saved_chunks", [("username", 1), ("chunkID", 1)]),
+]
+
+_map_indexes_ensured = False
+
+# MongoClient giữ connection pool riêng và thread-safe => tạo MỘT lần cho cả
+# process (như get_engine bên postgre_client) thay vì mỗi lần gọi một client
+# mới kèm chi phí handshake + pool mới.
+_client = None
+_db = None
+
+def _ensure_map_indexes(db):
+    """Tạo index cho các field map ID (1 lần mỗi process, create_index idempotent)."""
+    global _map_indexes_ensured
+    if _map_indexes_ensured:
+        return
+    try:
+        for col, keys in _MAP_INDEX_SPECS:
+            db[col].create_index(keys)
+        _map_indexes_ensured = True
+    except Exception:
+        # không chặn app vì lỗi tạo index; lần gọi sau sẽ thử lại
+        pass
+
 def get_mongo_client():
-    _load_env()
-    URI = os.getenv("MONGODB_URI")
-    DB = os.getenv("MONGODB_DB")
+    global _client, _db
+    if _client is None:
+        _load_env()
+        URI = os.getenv("MONGODB_URI")
+        DB = os.getenv("MONGODB_DB")
 
-    missing = [k for k, v in {
-        "MONGODB_URI": URI,
-        "MONGODB_DB": DB
-    }.items() if not v ]
+        missing = [k for k, v in {
+            "MONGODB_URI": URI,
+            "MONGODB_DB": DB
+        }.items() if not v ]
 
-    if missing:
-        raise RuntimeError(f"Missing env vars: {', '.join(missing)} (check your config.env file)")
+        if missing:
+            raise RuntimeError(f"Missing env vars: {', '.join(missing)} (check your config.env file)")
 
-    client = MongoClient(URI)
-    db = client[DB]
-    return {"client": client, "db": db}
+        _client = MongoClient(URI)
+        _db = _client[DB]
+    _ensure_map_indexes(_db)
+    return {"client": _client, "db": _db}
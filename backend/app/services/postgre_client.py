@@ -59,7 +59,17 @@ def get_engine() -> Engine:
         name = os.getenv("PG_NAME", "dataa")
 
         url = f"postgresql://{user}:{password}@{host}:{port}/{name}"
-        _engine = create_engine(url, pool_pre_ping=True)
+        # executemany_mode="values_plus_batch": psycopg2 gom executemany thành
+        # multi-VALUES (tương đương reWriteBatchedInserts của JDBC). Trên
+        # SQLAlchemy 2.0 INSERT đã đi qua insertmanyvalues nên mode này chỉ
+        # còn tác dụng với executemany không phải INSERT (UPDATE/DELETE);
+        # executemany_values_page_size đã bị 2.0 bỏ nên không truyền nữa.
+        _engine = create_engine(
+            url,
+            pool_pre_ping=True,
+            executemany_mode="values_plus_batch",
+            executemany_batch_page_size=500,
+        )
     return _engine
 
 
@@ -19,12 +19,18 @@ Nguồn Mongo (plural): classes, subjects, topics, lessons, chunks.
 """
 
 import hashlib
+import json
+import os
 import re
+import time
 import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import List, Optional, Tuple
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
 
 from bson import ObjectId
+from psycopg2.extras import execute_values
 from sqlalchemy import text
 
 from .mongo_client import get_mongo_client
@@ -33,42 +39,125 @@ from .db_migrations import ensure_postgre_search_columns
 from .keyword_embedding import embed_keyword_cached
 
 
+# BLAKE2b nhanh hơn SHA-2 rõ rệt trên CPU không có SHA extensions và có sẵn
+# trong stdlib. Vì đổi thuật toán là đổi PK đã lưu trong Postgre nên chỉ bật
+# qua env PG_SYNC_HASH_V2=1 sau khi đã backfill dữ liệu cũ.
+_HASH_V2 = os.getenv("PG_SYNC_HASH_V2", "").strip().lower() in {"1", "true", "yes"}
+
+# Precompile các regex dùng lặp lại trong hot path (mỗi keyword/mỗi map id một lần)
+# để khỏi phụ thuộc vào LRU cache nội bộ của `re` (có thể bị evict dưới tải).
+_SLUG_RE = re.compile(r"[^0-9A-Za-z]+")
+_SUBJ_RE = re.compile(r"^(TH\d{2})(?:[-_]?([A-Za-z]+))?$", flags=re.I)
+_CD_RE = re.compile(r"_CD(\d+)$", flags=re.I)
+_CD_B_RE = re.compile(r"_CD(\d+)_B(\d+)$", flags=re.I)
+_CD_B_C_RE = re.compile(r"_CD(\d+)_B(\d+)_C(\d+)$", flags=re.I)
+
+
+# Ghi chú chọn thuật toán: SHA-NI chỉ tăng tốc SHA-1/256 (không SHA-384/512),
+# còn blake3 không nằm trong requirements. Đổi sang SHA-256 truncate sẽ sinh
+# format ID thứ ba không tương thích với dữ liệu đã lưu, nên BLAKE2b qua gate
+# _HASH_V2 vẫn là đường nâng cấp duy nhất — với input ngắn như ở đây thì
+# overhead Python/hashlib lấn át chênh lệch core hash. Nhánh chọn thuật toán
+# được quyết định MỘT lần lúc import thay vì mỗi call.
+if _HASH_V2:
+    def _digest_32(data: bytes) -> str:
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def _digest_64(data: bytes) -> str:
+        return hashlib.blake2b(data, digest_size=32).hexdigest()
+
+    def _hash_96_bytes(data: bytes) -> str:
+        return hashlib.blake2b(data, digest_size=48).hexdigest()
+else:
+    def _digest_32(data: bytes) -> str:
+        return hashlib.md5(data, usedforsecurity=False).hexdigest()[:32]
+
+    def _digest_64(data: bytes) -> str:
+        return hashlib.sha256(data, usedforsecurity=False).hexdigest()[:64]
+
+    def _hash_96_bytes(data: bytes) -> str:
+        return hashlib.sha384(data, usedforsecurity=False).hexdigest()[:96]
+
+
+# Các hàm hash là pure function trên string ngắn (mongo _id 24 hex chars),
+# re-sync cùng một doc sẽ gọi lại y hệt => memoize cho rẻ.
+@lru_cache(maxsize=65536)
 def _md5_32(s: str) -> str:
-    return hashlib.md5(s.encode("utf-8")).hexdigest()[:32]
+    return _digest_32(s.encode("utf-8"))
 
 
+@lru_cache(maxsize=65536)
 def _sha256_64(s: str) -> str:
-    return hashlib.sha256(s.encode("utf-8")).hexdigest()[:64]
+    return _digest_64(s.encode("utf-8"))
 
 
+@lru_cache(maxsize=65536)
 def _sha384_96(s: str) -> str:
-    return hashlib.sha384(s.encode("utf-8")).hexdigest()[:96]
+    return _hash_96_bytes(s.encode("utf-8"))
+
+
+def _keyword_id_hasher(chunk_id: str):
+    """Hash fallback keyword_id = hash("{chunk_id}:{kw_name}") cho N keyword.
+
+    Prefix "{chunk_id}:" được nạp vào hasher MỘT lần rồi copy() state cho từng
+    keyword (memcpy vài trăm byte) thay vì N lần init + N f-string. Output giống
+    hệt _sha384_96(f"{chunk_id}:{kw_name}").
+    """
+    if _HASH_V2:
+        base = hashlib.blake2b(digest_size=48)
+    else:
+        base = hashlib.sha384(usedforsecurity=False)
+    base.update(chunk_id.encode("utf-8") + b":")
+
+    def _kw_id(kw_name: str) -> str:
+        h = base.copy()
+        h.update(kw_name.encode("utf-8"))
+        return h.hexdigest()[:96]
+
+    return _kw_id
 
 
 def _clean(s) -> str:
-    return "" if s is None else str(s).strip()
+    # Hot path: giá trị từ Mongo gần như luôn là str sẵn => tránh str() allocation.
+    if s is None:
+        return ""
+    if isinstance(s, str):
+        return s.strip()
+    return str(s).strip()
 
 
 def _ensure_oid(id_str: str) -> ObjectId:
-    try:
-        return ObjectId(id_str)
-    except Exception as e:
-        raise ValueError(f"Invalid mongo id: {id_str}") from e
+    if not ObjectId.is_valid(id_str):
+        raise ValueError(f"Invalid mongo id: {id_str}")
+    return ObjectId(id_str)
+
+
+# Projection theo collection: chỉ kéo các field mà sync thực sự đọc.
+# Doc chunk/lesson có thể mang text body lớn mà PG sync không dùng tới.
+# Mọi đường đọc Mongo trong module (find_one / $in batch / $lookup aggregation)
+# đều phải đi qua bộ projection này — thêm field mới thì khai báo ở đây.
+_SYNC_PROJECTIONS = {
+    "classes": {"classID": 1, "className": 1},
+    "subjects": {"subjectID": 1, "subjectName": 1, "classID": 1, "keywordSubject": 1},
+    "topics": {"topicID": 1, "topicName": 1, "subjectID": 1, "keywordTopic": 1},
+    "lessons": {"lessonID": 1, "lessonName": 1, "topicID": 1, "keywordLesson": 1, "lessonType": 1, "lesson_type": 1},
+    "chunks": {"chunkID": 1, "chunkName": 1, "chunkType": 1, "chunk_type": 1, "type": 1, "lessonID": 1, "keywords": 1},
+}
+
+_KEYWORD_PROJECTION = {"keywordID": 1, "keywordName": 1, "keyword_name": 1, "name": 1, "keywordEmbedding": 1, "chunkID": 1}
 
 
 def _pick_by_oid(db, col: str, _id: str) -> dict:
-    doc = db[col].find_one({"_id": _ensure_oid(_id)})
+    doc = db[col].find_one({"_id": _ensure_oid(_id)}, projection=_SYNC_PROJECTIONS.get(col))
     if not doc:
         raise ValueError(f"Mongo doc not found: {col}({_id})")
     return doc
 
 
-def _get_pk_by_mongo(conn, table: str, pk_col: str, mongo_id: str) -> Optional[str]:
-    row = conn.execute(
-        text(f"SELECT {pk_col} FROM {table} WHERE mongo_id = :mongo_id LIMIT 1"),
-        {"mongo_id": mongo_id},
-    ).fetchone()
-    return row[0] if row else None
+def _chunk_content_hash(fields: dict) -> str:
+    """Hash nội dung sẽ được ghi sang PG; hash trùng => doc không đổi, bỏ qua upsert."""
+    payload = json.dumps(fields, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
 
 
 
@@ -99,7 +188,9 @@ def _get_keywords_for_chunk(db, *, chunk_map: str, chunk_doc: Optional[dict] = N
 
     if chunk_map:
         try:
-            kw_docs = list(db["keywords"].find({"chunkID": chunk_map}).sort("keywordID", 1))
+            kw_docs = list(
+                db["keywords"].find({"chunkID": chunk_map}, projection=_KEYWORD_PROJECTION).sort("keywordID", 1)
+            )
         except Exception:
             kw_docs = []
 
@@ -119,6 +210,24 @@ def _get_keywords_for_chunk(db, *, chunk_map: str, chunk_doc: Optional[dict] = N
     return out
 
 
+def _dedupe_keyword_docs(kw_docs: List[dict]) -> List[Tuple[str, dict]]:
+    """Trả về (kw_name, doc) đã lọc tên rỗng + trùng tên (case-insensitive).
+
+    Dedupe trước khi hash/insert: keyword trùng sinh ra cùng kw_id và chỉ gây
+    ON CONFLICT churn vô ích.
+    """
+    out: List[Tuple[str, dict]] = []
+    seen = set()
+    for d in kw_docs:
+        kw_name = _clean(d.get("keywordName") or d.get("keyword_name") or d.get("name"))
+        key = kw_name.casefold()
+        if not kw_name or key in seen:
+            continue
+        seen.add(key)
+        out.append((kw_name, d))
+    return out
+
+
 def _normalize_keyword_values(value) -> List[str]:
     if isinstance(value, list):
         out: List[str] = []
@@ -141,7 +250,8 @@ def _keyword_id_from_map_id(map_id: str, keyword_name: str) -> str:
     slug = _keyword_slug(keyword_name)
     if slug:
         return f"{map_id}::{slug}"
-    return _sha384_96(f"{map_id}:{keyword_name}")
+    # fallback hash: ghép bytes thẳng vào hasher, khỏi tạo f-string trung gian
+    return _hash_96_bytes(b":".join((map_id.encode("utf-8"), keyword_name.encode("utf-8"))))
 
 
 def _keyword_row_payload(map_id: str, keyword_name: str, mongo_id: Optional[str], embedding) -> dict:
@@ -199,39 +309,123 @@ def _collect_hierarchy_keyword_payloads(
                 )
             )
 
+    # dedupe theo keyword_id cuối cùng: hai tên khác nhau có thể slug ra cùng
+    # một id (vd "Xin chào" / "xin-chao") và sẽ upsert đè nhau vô ích
     deduped: List[dict] = []
     seen = set()
     for item in payloads:
-        key = (item["map_id"], item["keyword_name"].casefold())
-        if key in seen:
+        if item["keyword_id"] in seen:
             continue
-        seen.add(key)
+        seen.add(item["keyword_id"])
         deduped.append(item)
     return deduped
 
 
+def _build_chunk_keyword_rows(chunk_id: str, kw_docs: List[dict]) -> List[dict]:
+    """Dựng sẵn row keyword (hash id + embedding) TRƯỚC khi mở transaction PG.
+
+    Hash/embedding là việc CPU thuần; làm ngoài transaction để không giữ
+    connection + lock mở trong lúc tính toán.
+    """
+    kw_hash_id = _keyword_id_hasher(chunk_id)
+    rows: List[dict] = []
+    seen_ids = set()
+    for kw_name, d in _dedupe_keyword_docs(kw_docs):
+        # keyword_id: ưu tiên map id (TH10_..._K1). Nếu thiếu => fallback hash.
+        kw_id = _clean(d.get("keywordID")) or kw_hash_id(kw_name)
+        if kw_id in seen_ids:
+            # tên khác nhau nhưng trùng id (slug collision) => giữ bản đầu tiên
+            continue
+        seen_ids.add(kw_id)
+        kw_emb = d.get("keywordEmbedding")
+        if kw_emb is not None and not isinstance(kw_emb, list):
+            kw_emb = None
+        if kw_emb is None:
+            kw_emb = embed_keyword_cached(kw_name)
+        rows.append({
+            "keyword_id": kw_id,
+            "keyword_name": kw_name,
+            "keyword_embedding": kw_emb,
+            "mongo_id": str(d.get("_id")) if d.get("_id") is not None else None,
+            "map_id": chunk_id,
+        })
+    return rows
+
+
+# Mỗi page 500 row vẫn cách xa giới hạn kích thước statement của PG.
+_KEYWORD_UPSERT_BATCH = 500
+
+_KEYWORD_UPSERT_VALUES_SQL = """
+    INSERT INTO keyword (keyword_id, keyword_name, keyword_embedding, mongo_id, map_id)
+    VALUES %s
+    ON CONFLICT (keyword_id) DO UPDATE
+    SET keyword_name      = EXCLUDED.keyword_name,
+        keyword_embedding = COALESCE(EXCLUDED.keyword_embedding, keyword.keyword_embedding),
+        mongo_id          = COALESCE(EXCLUDED.mongo_id, keyword.mongo_id),
+        map_id            = EXCLUDED.map_id
+"""
+
+
+def _insert_keyword_rows(conn, keyword_rows: List[dict]) -> None:
+    """Upsert keyword theo lô qua execute_values: 1 statement nhiều VALUES/page.
+
+    execute_values nội suy value phía client nên bỏ hẳn chi phí dựng và bind
+    hàng nghìn named param qua SQLAlchemy; psycopg2 tự adapt list -> ARRAY.
+    """
+    # đề phòng keyword_id trùng trong cùng statement (PG từ chối update 1 row 2 lần)
+    unique_rows: List[Tuple] = []
+    seen_ids = set()
+    for item in keyword_rows:
+        if item["keyword_id"] in seen_ids:
+            continue
+        seen_ids.add(item["keyword_id"])
+        unique_rows.append((
+            item["keyword_id"],
+            item["keyword_name"],
+            item["keyword_embedding"],
+            item["mongo_id"],
+            item["map_id"],
+        ))
+    if not unique_rows:
+        return
+
+    raw_cursor = conn.connection.cursor()
+    try:
+        execute_values(
+            raw_cursor,
+            _KEYWORD_UPSERT_VALUES_SQL,
+            unique_rows,
+            page_size=_KEYWORD_UPSERT_BATCH,
+        )
+    finally:
+        raw_cursor.close()
+
+
+# SQL hoisted ra module-level: text() chỉ build 1 lần, cache key trong
+# compiled-cache của SQLAlchemy ổn định theo identity => không re-parse/compile
+# lại statement cho mỗi lần sync (psycopg2 không có prepared statement phía
+# driver nên phần tiết kiệm nằm ở tầng Python/SQLAlchemy).
+_PRUNE_KEYWORDS_SQL = text(
+    "DELETE FROM keyword WHERE map_id = ANY(:map_ids) AND NOT (keyword_id = ANY(:keep_ids))"
+)
+_DELETE_KEYWORDS_SQL = text("DELETE FROM keyword WHERE map_id = ANY(:map_ids)")
+
+
 def _refresh_keyword_rows(conn, keyword_payloads: List[dict], map_ids: List[str]) -> List[str]:
+    """Đồng bộ keyword kiểu diff: upsert bộ hiện tại, rồi chỉ DELETE row thừa.
+
+    DELETE-all + re-INSERT cũ ghi lại N row (WAL + index churn) cả khi bộ
+    keyword không đổi; giờ keyword ổn định chỉ tốn 1 update ON CONFLICT.
+    """
+    keep_ids = [item["keyword_id"] for item in keyword_payloads]
+    _insert_keyword_rows(conn, keyword_payloads)
     clean_map_ids = [mid for mid in map_ids if _clean(mid)]
     if clean_map_ids:
-        conn.execute(text("DELETE FROM keyword WHERE map_id = ANY(:map_ids)"), {"map_ids": clean_map_ids})
-    keyword_ids: List[str] = []
-    for item in keyword_payloads:
-        keyword_ids.append(item["keyword_id"])
-        conn.execute(
-            text(
-                """
-                INSERT INTO keyword (keyword_id, keyword_name, keyword_embedding, mongo_id, map_id)
-                VALUES (:keyword_id, :keyword_name, :keyword_embedding, :mongo_id, :map_id)
-                ON CONFLICT (keyword_id) DO UPDATE
-                SET keyword_name      = EXCLUDED.keyword_name,
-                    keyword_embedding = COALESCE(EXCLUDED.keyword_embedding, keyword.keyword_embedding),
-                    mongo_id          = COALESCE(EXCLUDED.mongo_id, keyword.mongo_id),
-                    map_id            = EXCLUDED.map_id
-                """
-            ),
-            item,
-        )
-    return keyword_ids
+        if keep_ids:
+            conn.execute(_PRUNE_KEYWORDS_SQL, {"map_ids": clean_map_ids, "keep_ids": keep_ids})
+        else:
+            conn.execute(_DELETE_KEYWORDS_SQL, {"map_ids": clean_map_ids})
+    return keep_ids
 
 
 @dataclass
@@ -244,13 +438,19 @@ class PgIds:
     keyword_ids: List[str]
 
 
+# Bảng xoá combining marks (U+0300..U+036F phủ toàn bộ dấu tiếng Việt sau NFD);
+# str.translate chạy 1 vòng lặp C thay vì gọi unicodedata.category cho từng ký tự.
+_COMBINING_MARKS = dict.fromkeys(
+    c for c in range(0x0300, 0x0370) if unicodedata.category(chr(c)) == "Mn"
+)
+
+
 def _strip_accents(s: str) -> str:
     """Bỏ dấu tiếng Việt nhưng GIỮ nguyên chữ hoa/thường."""
     if not s:
         return ""
-    # NFD tách dấu ra khỏi ký tự
-    nf = unicodedata.normalize("NFD", s)
-    return "".join(ch for ch in nf if unicodedata.category(ch) != "Mn")
+    # NFD tách dấu ra khỏi ký tự rồi translate xoá các dấu đó
+    return unicodedata.normalize("NFD", s).translate(_COMBINING_MARKS)
 
 
 def _keyword_slug(name: str) -> str:
@@ -262,7 +462,7 @@ def _keyword_slug(name: str) -> str:
     """
     s = _strip_accents(_clean(name))
     # chỉ giữ chữ + số
-    s = re.sub(r"[^0-9A-Za-z]+", "", s)
+    s = _SLUG_RE.sub("", s)
     return s
 
 
@@ -302,7 +502,7 @@ def _normalize_subject_id(subject_map: str, *, class_id: str, subject_name: str)
             sm = "TH"
 
     # tách prefix THxx
-    m = re.match(r"^(TH\d{2})(?:[-_]?([A-Za-z]+))?$", sm, flags=re.I)
+    m = _SUBJ_RE.match(sm)
     if not m:
         return sm
 
@@ -323,17 +523,17 @@ def _normalize_subject_id(subject_map: str, *, class_id: str, subject_name: str)
 
 
 def _parse_topic_number_from_topic_map(topic_map: str) -> str:
-    m = re.search(r"_CD(\d+)$", _clean(topic_map), flags=re.I)
+    m = _CD_RE.search(_clean(topic_map))
     return m.group(1) if m else ""
 
 
 def _parse_topic_lesson_numbers_from_lesson_map(lesson_map: str) -> Tuple[str, str]:
-    m = re.search(r"_CD(\d+)_B(\d+)$", _clean(lesson_map), flags=re.I)
+    m = _CD_B_RE.search(_clean(lesson_map))
     return (m.group(1), m.group(2)) if m else ("", "")
 
 
 def _parse_topic_lesson_chunk_numbers_from_chunk_map(chunk_map: str) -> Tuple[str, str, str]:
-    m = re.search(r"_CD(\d+)_B(\d+)_C(\d+)$", _clean(chunk_map), flags=re.I)
+    m = _CD_B_C_RE.search(_clean(chunk_map))
     return (m.group(1), m.group(2), m.group(3)) if m else ("", "", "")
 
 
@@ -377,104 +577,188 @@ def _derive_hierarchy_numbers(
     return topic_number, lesson_number, chunk_number
 
 
-def _upsert_topic(
-    conn,
-    *,
-    topic_id: str,
-    topic_name: str,
-    mongo_id: Optional[str],
-    subject_id: Optional[str],
-    topic_number: Optional[int],
-) -> None:
-    conn.execute(
-        text(
-            """
-            INSERT INTO topic (topic_id, topic_name, mongo_id, subject_id, topic_number)
-            VALUES (:topic_id, :topic_name, :mongo_id, :subject_id, :topic_number)
-            ON CONFLICT (topic_id) DO UPDATE
-            SET topic_name    = EXCLUDED.topic_name,
-                mongo_id      = COALESCE(EXCLUDED.mongo_id, topic.mongo_id),
-                subject_id    = EXCLUDED.subject_id,
-                topic_number  = COALESCE(EXCLUDED.topic_number, topic.topic_number)
-            """
-        ),
-        {
-            "topic_id": topic_id,
-            "topic_name": topic_name,
-            "mongo_id": mongo_id,
-            "subject_id": subject_id,
-            "topic_number": topic_number,
-        },
-    )
+# Mảnh upsert theo PK (map id) cho từng level. Bind param prefix theo level
+# để có thể ghép nhiều mảnh vào MỘT statement WITH-CTE (1 round-trip thay vì
+# tối đa 5 — mỗi upsert độc lập vì PK đã biết trước phía client).
+_CHAIN_UPSERT_FRAGMENTS = {
+    "class": """
+        INSERT INTO class (class_id, class_name, mongo_id)
+        VALUES (:class_id, :class_name, :class_mongo_id)
+        ON CONFLICT (class_id) DO UPDATE
+        SET class_name = EXCLUDED.class_name,
+            mongo_id   = COALESCE(EXCLUDED.mongo_id, class.mongo_id)
+    """,
+    "subject": """
+        INSERT INTO subject (subject_id, subject_name, mongo_id, class_id)
+        VALUES (:subject_id, :subject_name, :subject_mongo_id, :subject_class_id)
+        ON CONFLICT (subject_id) DO UPDATE
+        SET subject_name = EXCLUDED.subject_name,
+            mongo_id     = COALESCE(EXCLUDED.mongo_id, subject.mongo_id),
+            class_id     = EXCLUDED.class_id
+    """,
+    "topic": """
+        INSERT INTO topic (topic_id, topic_name, mongo_id, subject_id, topic_number)
+        VALUES (:topic_id, :topic_name, :topic_mongo_id, :topic_subject_id, :topic_number)
+        ON CONFLICT (topic_id) DO UPDATE
+        SET topic_name    = EXCLUDED.topic_name,
+            mongo_id      = COALESCE(EXCLUDED.mongo_id, topic.mongo_id),
+            subject_id    = EXCLUDED.subject_id,
+            topic_number  = COALESCE(EXCLUDED.topic_number, topic.topic_number)
+    """,
+    "lesson": """
+        INSERT INTO lesson (lesson_id, lesson_name, mongo_id, topic_id, lesson_number)
+        VALUES (:lesson_id, :lesson_name, :lesson_mongo_id, :lesson_topic_id, :lesson_number)
+        ON CONFLICT (lesson_id) DO UPDATE
+        SET lesson_name    = EXCLUDED.lesson_name,
+            mongo_id       = COALESCE(EXCLUDED.mongo_id, lesson.mongo_id),
+            topic_id       = EXCLUDED.topic_id,
+            lesson_number  = COALESCE(EXCLUDED.lesson_number, lesson.lesson_number)
+    """,
+    "chunk": """
+        INSERT INTO chunk (chunk_id, chunk_name, chunk_type, mongo_id, lesson_id, chunk_number, content_hash)
+        VALUES (:chunk_id, :chunk_name, :chunk_type, :chunk_mongo_id, :chunk_lesson_id, :chunk_number, :content_hash)
+        ON CONFLICT (chunk_id) DO UPDATE
+        SET chunk_name    = EXCLUDED.chunk_name,
+            chunk_type    = EXCLUDED.chunk_type,
+            mongo_id      = COALESCE(EXCLUDED.mongo_id, chunk.mongo_id),
+            lesson_id     = EXCLUDED.lesson_id,
+            chunk_number  = COALESCE(EXCLUDED.chunk_number, chunk.chunk_number),
+            content_hash  = EXCLUDED.content_hash
+    """,
+}
+
+
+@lru_cache(maxsize=32)
+def _chain_upsert_sql(level_names: Tuple[str, ...]):
+    """Ghép các mảnh upsert thành 1 statement (CTE); cache theo tổ hợp level."""
+    bodies = [_CHAIN_UPSERT_FRAGMENTS[name].strip() for name in level_names]
+    if len(bodies) == 1:
+        return text(bodies[0])
+    ctes = ", ".join(f"up_{name} AS ({body})" for name, body in zip(level_names[:-1], bodies[:-1]))
+    return text(f"WITH {ctes} {bodies[-1]}")
+
+
+# Fingerprint các level ĐÃ COMMIT với đúng bộ giá trị này: gặp lại trong TTL
+# => row PG chắc chắn đã ở trạng thái đích, bỏ qua upsert (đỡ WAL + index).
+# Lưu ý: cache chỉ biết ghi của process này — ai xoá row từ ngoài (vd cascade
+# delete cả class) thì re-sync trong TTL không tự vá; TTL 10' là trần chịu lệch.
+_SYNCED_LEVEL_TTL = 600.0
+_SYNCED_LEVEL_CACHE_MAX = 10_000
+_synced_level_cache: Dict[str, float] = {}
+
+
+def _level_fingerprint(name: str, params: dict) -> str:
+    payload = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.blake2b(f"{name}|{payload}".encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _upsert_chain_by_map(conn, levels: List[Tuple[str, dict]], *, in_tx_fps: Optional[set] = None) -> List[str]:
+    """Upsert các level được yêu cầu trong MỘT round-trip duy nhất.
+
+    Level có fingerprint còn tươi trong cache (đã commit y hệt gần đây)
+    được lược khỏi statement luôn. Trả về fingerprint của các level vừa
+    upsert để caller ghi cache bằng _record_synced_levels SAU khi
+    transaction commit — ghi ngay tại đây thì một lần rollback (vd
+    _refresh_keyword_rows lỗi ngay sau upsert) sẽ khiến mọi retry trong
+    TTL bỏ qua upsert dù row chưa hề được ghi.
+
+    in_tx_fps: set dùng chung khi gọi nhiều lần trong cùng một
+    transaction để lược ancestor trùng giữa các chunk trong lô.
+    """
+    now = time.monotonic()
+    pending: List[Tuple[str, dict]] = []
+    fingerprints: List[str] = []
+    for name, level_params in levels:
+        fp = _level_fingerprint(name, level_params)
+        if _synced_level_cache.get(fp, 0.0) > now:
+            continue
+        if in_tx_fps is not None:
+            if fp in in_tx_fps:
+                continue
+            in_tx_fps.add(fp)
+        pending.append((name, level_params))
+        fingerprints.append(fp)
+    if not pending:
+        return []
 
+    params: dict = {}
+    for _name, level_params in pending:
+        params.update(level_params)
+    conn.execute(_chain_upsert_sql(tuple(name for name, _ in pending)), params)
+    return fingerprints
 
-def _upsert_lesson(
-    conn,
-    *,
-    lesson_id: str,
-    lesson_name: str,
-    mongo_id: Optional[str],
-    topic_id: Optional[str],
-    lesson_number: Optional[int],
-) -> None:
-    conn.execute(
-        text(
-            """
-            INSERT INTO lesson (lesson_id, lesson_name, mongo_id, topic_id, lesson_number)
-            VALUES (:lesson_id, :lesson_name, :mongo_id, :topic_id, :lesson_number)
-            ON CONFLICT (lesson_id) DO UPDATE
-            SET lesson_name    = EXCLUDED.lesson_name,
-                mongo_id       = COALESCE(EXCLUDED.mongo_id, lesson.mongo_id),
-                topic_id       = EXCLUDED.topic_id,
-                lesson_number  = COALESCE(EXCLUDED.lesson_number, lesson.lesson_number)
-            """
-        ),
-        {
-            "lesson_id": lesson_id,
-            "lesson_name": lesson_name,
-            "mongo_id": mongo_id,
-            "topic_id": topic_id,
-            "lesson_number": lesson_number,
-        },
-    )
 
+def _record_synced_levels(fingerprints: List[str]) -> None:
+    """Đánh dấu các fingerprint đã commit; chỉ gọi sau khi engine.begin() thoát."""
+    if not fingerprints:
+        return
+    if len(_synced_level_cache) >= _SYNCED_LEVEL_CACHE_MAX:
+        _synced_level_cache.clear()
+    expires = time.monotonic() + _SYNCED_LEVEL_TTL
+    for fp in fingerprints:
+        _synced_level_cache[fp] = expires
 
-def _upsert_chunk(
-    conn,
-    *,
-    chunk_id: str = "",
-    map_id: str = "",
-    chunk_name: str,
-    chunk_type: Optional[str],
-    mongo_id: Optional[str],
-    lesson_id: Optional[str],
-    chunk_number: Optional[int],
-) -> None:
-    actual_chunk_id = _clean(chunk_id) or _clean(map_id)
-    if not actual_chunk_id:
-        raise ValueError("chunk_id/map_id is required for chunk upsert")
-    conn.execute(
-        text(
-            """
-            INSERT INTO chunk (chunk_id, chunk_name, chunk_type, mongo_id, lesson_id, chunk_number)
-            VALUES (:chunk_id, :chunk_name, :chunk_type, :mongo_id, :lesson_id, :chunk_number)
-            ON CONFLICT (chunk_id) DO UPDATE
-            SET chunk_name    = EXCLUDED.chunk_name,
-                chunk_type    = EXCLUDED.chunk_type,
-                mongo_id      = COALESCE(EXCLUDED.mongo_id, chunk.mongo_id),
-                lesson_id     = EXCLUDED.lesson_id,
-                chunk_number  = COALESCE(EXCLUDED.chunk_number, chunk.chunk_number)
-            """
-        ),
-        {
-            "chunk_id": actual_chunk_id,
-            "chunk_name": chunk_name,
-            "chunk_type": chunk_type,
-            "mongo_id": mongo_id,
-            "lesson_id": lesson_id,
-            "chunk_number": chunk_number,
-        },
+
+# Upsert cả chain theo mongo_id (unique) trong 1 statement: mỗi CTE RETURNING
+# pk thật để CTE sau dùng làm FK, statement cuối trả chunk_id.
+_UPSERT_CHAIN_BY_MONGO_SQL = text(
+    """
+    WITH up_class AS (
+        INSERT INTO class (class_id, class_name, mongo_id)
+        VALUES (:class_id, :class_name, :class_mongo_id)
+        ON CONFLICT (mongo_id) DO UPDATE
+        SET class_name = EXCLUDED.class_name
+        RETURNING class_id
+    ), up_subject AS (
+        INSERT INTO subject (subject_id, subject_name, mongo_id, class_id)
+        SELECT :subject_id, :subject_name, :subject_mongo_id, up_class.class_id FROM up_class
+        ON CONFLICT (mongo_id) DO UPDATE
+        SET subject_name = EXCLUDED.subject_name,
+            class_id     = EXCLUDED.class_id
+        RETURNING subject_id
+    ), up_topic AS (
+        INSERT INTO topic (topic_id, topic_name, mongo_id, subject_id, topic_number)
+        SELECT :topic_id, :topic_name, :topic_mongo_id, up_subject.subject_id, :topic_number FROM up_subject
+        ON CONFLICT (mongo_id) DO UPDATE
+        SET topic_name    = EXCLUDED.topic_name,
+            subject_id    = EXCLUDED.subject_id,
+            topic_number  = COALESCE(EXCLUDED.topic_number, topic.topic_number)
+        RETURNING topic_id
+    ), up_lesson AS (
+        INSERT INTO lesson (lesson_id, lesson_name, mongo_id, topic_id, lesson_number)
+        SELECT :lesson_id, :lesson_name, :lesson_mongo_id, up_topic.topic_id, :lesson_number FROM up_topic
+        ON CONFLICT (mongo_id) DO UPDATE
+        SET lesson_name    = EXCLUDED.lesson_name,
+            topic_id       = EXCLUDED.topic_id,
+            lesson_number  = COALESCE(EXCLUDED.lesson_number, lesson.lesson_number)
+        RETURNING lesson_id
     )
+    INSERT INTO chunk (chunk_id, chunk_name, chunk_type, mongo_id, lesson_id, chunk_number, content_hash)
+    SELECT :chunk_id, :chunk_name, :chunk_type, :chunk_mongo_id, up_lesson.lesson_id, :chunk_number, :content_hash FROM up_lesson
+    ON CONFLICT (mongo_id) DO UPDATE
+    SET chunk_name    = EXCLUDED.chunk_name,
+        chunk_type    = EXCLUDED.chunk_type,
+        lesson_id     = EXCLUDED.lesson_id,
+        chunk_number  = COALESCE(EXCLUDED.chunk_number, chunk.chunk_number),
+        content_hash  = EXCLUDED.content_hash
+    RETURNING chunk_id
+    """
+)
+
+_SELECT_CHUNK_HASH_BY_MONGO_SQL = text(
+    "SELECT chunk_id, content_hash FROM chunk WHERE mongo_id = :mongo_id LIMIT 1"
+)
+
+_SELECT_CHUNK_HASH_SQL = text(
+    "SELECT content_hash FROM chunk WHERE chunk_id = :chunk_id LIMIT 1"
+)
+
+
+def _stored_chunk_hash(engine, chunk_id: str) -> Optional[str]:
+    """Đọc content_hash đã lưu của chunk trên connection AUTOCOMMIT riêng."""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as read_conn:
+        row = read_conn.execute(_SELECT_CHUNK_HASH_SQL, {"chunk_id": chunk_id}).fetchone()
+    return row[0] if row else None
 
 
 # ======================================================================================
@@ -519,6 +803,27 @@ def sync_postgre_from_mongo_ids(
 
     kw_docs = _get_keywords_for_chunk(db, chunk_map=chunk_map, chunk_doc=ch_doc)
 
+    content_hash = _chunk_content_hash({
+        "class_name": class_name,
+        "subject_name": subject_name,
+        "topic_name": topic_name,
+        "lesson_name": lesson_name,
+        "chunk_name": chunk_name,
+        "chunk_type": chunk_type,
+        "topic_map": topic_map,
+        "lesson_map": lesson_map,
+        "chunk_map": chunk_map,
+        "keywords": [
+            {
+                "keywordID": _clean(d.get("keywordID")),
+                "keywordName": _clean(d.get("keywordName") or d.get("keyword_name") or d.get("name")),
+                "mongo_id": str(d.get("_id")) if d.get("_id") is not None else None,
+                "has_embedding": isinstance(d.get("keywordEmbedding"), list),
+            }
+            for d in kw_docs
+        ],
+    })
+
     class_id_guess = _md5_32(mongo_class_id)
     subject_id_guess = _md5_32(mongo_subject_id)
     topic_id_guess = _sha256_64(mongo_topic_id)
@@ -527,112 +832,69 @@ def sync_postgre_from_mongo_ids(
 
     engine = get_engine()
 
-    with engine.begin() as conn:
-        class_id = _get_pk_by_mongo(conn, "class", "class_id", mongo_class_id) or class_id_guess
-        subject_id = _get_pk_by_mongo(conn, "subject", "subject_id", mongo_subject_id) or subject_id_guess
-        topic_id = _get_pk_by_mongo(conn, "topic", "topic_id", mongo_topic_id) or topic_id_guess
-        lesson_id = _get_pk_by_mongo(conn, "lesson", "lesson_id", mongo_lesson_id) or lesson_id_guess
-        chunk_id = _get_pk_by_mongo(conn, "chunk", "chunk_id", mongo_chunk_id) or chunk_id_guess
-
-        conn.execute(
-            text(
-                """
-                INSERT INTO class (class_id, class_name, mongo_id)
-                VALUES (:class_id, :class_name, :mongo_id)
-                ON CONFLICT (class_id) DO UPDATE
-                SET class_name = EXCLUDED.class_name,
-                    mongo_id   = COALESCE(EXCLUDED.mongo_id, class.mongo_id)
-                """
-            ),
-            {"class_id": class_id, "class_name": class_name, "mongo_id": mongo_class_id},
+    # Check nội-dung-không-đổi chạy trên connection AUTOCOMMIT riêng: không giữ
+    # transaction ghi mở trong lúc đọc => transaction phía dưới ngắn hơn,
+    # ít lock contention trên class/subject/... hơn.
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as read_conn:
+        row = read_conn.execute(
+            _SELECT_CHUNK_HASH_BY_MONGO_SQL,
+            {"mongo_id": mongo_chunk_id},
+        ).fetchone()
+
+    if row is not None and row[1] and row[1] == content_hash:
+        # Chunk đã sync trước đó và nội dung không đổi => bỏ qua toàn bộ upsert.
+        kw_hash_id = _keyword_id_hasher(row[0])
+        keyword_ids = list(dict.fromkeys(
+            _clean(d.get("keywordID")) or kw_hash_id(kw_name)
+            for kw_name, d in _dedupe_keyword_docs(kw_docs)
+        ))
+        return PgIds(
+            class_id=class_id_guess,
+            subject_id=subject_id_guess,
+            topic_id=topic_id_guess,
+            lesson_id=lesson_id_guess,
+            chunk_id=chunk_id_guess,
+            keyword_ids=keyword_ids,
         )
 
-        conn.execute(
-            text(
-                """
-                INSERT INTO subject (subject_id, subject_name, mongo_id, class_id)
-                VALUES (:subject_id, :subject_name, :mongo_id, :class_id)
-                ON CONFLICT (subject_id) DO UPDATE
-                SET subject_name = EXCLUDED.subject_name,
-                    mongo_id     = COALESCE(EXCLUDED.mongo_id, subject.mongo_id),
-                    class_id     = EXCLUDED.class_id
-                """
-            ),
+    # chunk_id thật đã biết trước transaction: row cũ giữ pk cũ (đọc được ở
+    # pre-read), row mới sẽ nhận hash guess => dựng keyword rows (hash +
+    # embedding, CPU thuần) NGOÀI transaction cho transaction ngắn nhất có thể.
+    keyword_rows = _build_chunk_keyword_rows(
+        row[0] if row is not None else chunk_id_guess, kw_docs
+    )
+
+    # Upsert cả chain trong MỘT statement: mỗi CTE RETURNING pk thật làm FK
+    # cho CTE sau, row đã tồn tại giữ pk cũ, row mới nhận pk hash guess.
+    # 5 round-trip PG gộp còn 1.
+    with engine.begin() as conn:
+        chunk_id = conn.execute(
+            _UPSERT_CHAIN_BY_MONGO_SQL,
             {
-                "subject_id": subject_id,
+                "class_id": class_id_guess,
+                "class_name": class_name,
+                "class_mongo_id": mongo_class_id,
+                "subject_id": subject_id_guess,
                 "subject_name": subject_name,
-                "mongo_id": mongo_subject_id,
-                "class_id": class_id,
+                "subject_mongo_id": mongo_subject_id,
+                "topic_id": topic_id_guess,
+                "topic_name": topic_name,
+                "topic_mongo_id": mongo_topic_id,
+                "topic_number": topic_number,
+                "lesson_id": lesson_id_guess,
+                "lesson_name": lesson_name,
+                "lesson_mongo_id": mongo_lesson_id,
+                "lesson_number": lesson_number,
+                "chunk_id": chunk_id_guess,
+                "chunk_name": chunk_name,
+                "chunk_type": chunk_type or None,
+                "chunk_mongo_id": mongo_chunk_id,
+                "chunk_number": chunk_number,
+                "content_hash": content_hash,
             },
-        )
+        ).scalar_one()
 
-        _upsert_topic(
-            conn,
-            topic_id=topic_id,
-            topic_name=topic_name,
-            mongo_id=mongo_topic_id,
-            subject_id=subject_id,
-            topic_number=topic_number,
-        )
-
-        _upsert_lesson(
-            conn,
-            lesson_id=lesson_id,
-            lesson_name=lesson_name,
-            mongo_id=mongo_lesson_id,
-            topic_id=topic_id,
-            lesson_number=lesson_number,
-        )
-
-        _upsert_chunk(
-            conn,
-            chunk_id=chunk_id,
-            chunk_name=chunk_name,
-            chunk_type=chunk_type or None,
-            mongo_id=mongo_chunk_id,
-            lesson_id=lesson_id,
-            chunk_number=chunk_number,
-        )
-
-        conn.execute(text("DELETE FROM keyword WHERE map_id = :map_id"), {"map_id": chunk_id})
-
-        keyword_ids: List[str] = []
-        for d in kw_docs:
-            kw_name = _clean(d.get("keywordName") or d.get("keyword_name") or d.get("name"))
-            if not kw_name:
-                continue
-
-            # keyword_id: ưu tiên map id (TH10_..._K1). Nếu thiếu => fallback hash.
-            kw_id = _clean(d.get("keywordID")) or _sha384_96(f"{chunk_id}:{kw_name}")
-            keyword_ids.append(kw_id)
-
-            mongo_kw_id = str(d.get("_id")) if d.get("_id") is not None else None
-            kw_emb = d.get("keywordEmbedding")
-            if kw_emb is not None and not isinstance(kw_emb, list):
-                kw_emb = None
-            if kw_emb is None:
-                kw_emb = embed_keyword_cached(kw_name)
-
-            conn.execute(
-                text(
-                    """
-                    INSERT INTO keyword (keyword_id, keyword_name, keyword_embedding, mongo_id, map_id)
-                    VALUES (:keyword_id, :keyword_name, :keyword_embedding, :mongo_id, :map_id)
-                    ON CONFLICT (keyword_id) DO UPDATE
-                    SET keyword_name      = EXCLUDED.keyword_name,
-                        keyword_embedding = COALESCE(EXCLUDED.keyword_embedding, keyword.keyword_embedding),
-                        mongo_id          = COALESCE(EXCLUDED.mongo_id, keyword.mongo_id),
-                        map_id            = EXCLUDED.map_id
-                    """
-                ),
-                {
-                    "keyword_id": kw_id,
-                    "keyword_name": kw_name,
-                    "keyword_embedding": kw_emb,
-                    "mongo_id": mongo_kw_id,
-                    "chunk_id": actual_chunk_id,
-                },
-            )
+        keyword_ids = _refresh_keyword_rows(conn, keyword_rows, [chunk_id])
 
     return PgIds(
         class_id=class_id_guess,
@@ -651,7 +913,89 @@ def sync_postgre_from_mongo_ids(
 def _pick_by_map(db, col: str, map_key: str, map_value: str) -> Optional[dict]:
     if not map_value:
         return None
-    return db[col].find_one({map_key: map_value})
+    return db[col].find_one({map_key: map_value}, projection=_SYNC_PROJECTIONS.get(col))
+
+
+# Thứ tự level từ sâu nhất -> nông nhất: (collection, map key, FK tới cha, alias)
+_CHAIN_LEVELS = [
+    ("chunks", "chunkID", "lessonID", "chunk"),
+    ("lessons", "lessonID", "topicID", "lesson"),
+    ("topics", "topicID", "subjectID", "topic"),
+    ("subjects", "subjectID", "classID", "subject"),
+    ("classes", "classID", None, "class"),
+]
+
+_CHAIN_ALIASES = {"chunk", "lesson", "topic", "subject", "class"}
+
+
+# Cache TTL in-process cho doc cha (class/subject/topic/lesson): các doc này
+# thay đổi rất hiếm nhưng bị fetch lại trên MỌI lần sync. Doc ở level sâu nhất
+# của request luôn được đọc tươi nên dữ liệu chính không bao giờ stale quá TTL.
+_CHAIN_DOC_TTL = 600.0
+_CHAIN_DOC_CACHE_MAX = 10_000
+_chain_doc_cache: Dict[Tuple[str, str], Tuple[float, dict]] = {}
+
+
+def _cached_chain_doc(col: str, map_value: str) -> Optional[dict]:
+    hit = _chain_doc_cache.get((col, map_value))
+    if hit is None:
+        return None
+    if hit[0] < time.monotonic():
+        _chain_doc_cache.pop((col, map_value), None)
+        return None
+    return hit[1]
+
+
+def _remember_chain_doc(col: str, map_value: str, doc: Optional[dict]) -> None:
+    if not map_value or not doc:
+        return
+    if len(_chain_doc_cache) >= _CHAIN_DOC_CACHE_MAX:
+        # đơn giản hoá: reset toàn bộ thay vì LRU (cache đầy là trường hợp hiếm)
+        _chain_doc_cache.clear()
+    _chain_doc_cache[(col, map_value)] = (time.monotonic() + _CHAIN_DOC_TTL, doc)
+
+
+def _aggregate_chain(db, start: int, maps: Dict[str, str]) -> Optional[Dict[str, Optional[dict]]]:
+    """Chạy 1 aggregation $lookup từ level `start` lên hết chain; None nếu doc gốc không có."""
+    root_col, root_key, root_fk, root_alias = _CHAIN_LEVELS[start]
+    pipeline: List[dict] = [
+        {"$match": {root_key: maps[root_col]}},
+        {"$limit": 1},
+        {"$project": dict(_SYNC_PROJECTIONS[root_col])},
+    ]
+
+    # FK path trên doc hiện tại trỏ tới level cha (vd "lessonID" rồi "lesson.topicID")
+    prev_fk_path = root_fk
+    for col, key, fk, alias in _CHAIN_LEVELS[start + 1:]:
+        sub_pipeline: List[dict] = []
+        if maps[col]:
+            # map tường minh => match hằng, bỏ qua FK suy ra
+            sub_pipeline.append({"$match": {key: maps[col]}})
+            lookup = {"from": col, "pipeline": sub_pipeline, "as": alias}
+        else:
+            sub_pipeline.append({"$match": {"$expr": {"$eq": [f"${key}", "$$fk"]}}})
+            lookup = {"from": col, "let": {"fk": f"${prev_fk_path}"}, "pipeline": sub_pipeline, "as": alias}
+        sub_pipeline.append({"$limit": 1})
+        sub_pipeline.append({"$project": dict(_SYNC_PROJECTIONS[col])})
+        pipeline.append({"$lookup": lookup})
+        pipeline.append({"$unwind": {"path": f"${alias}", "preserveNullAndEmptyArrays": True}})
+        prev_fk_path = f"{alias}.{fk}" if fk else None
+
+    row = next(iter(db[root_col].aggregate(pipeline)), None)
+    if row is None:
+        return None
+
+    docs: Dict[str, Optional[dict]] = {alias: row.get(alias) or None for alias in _CHAIN_ALIASES}
+    docs[root_alias] = {k: v for k, v in row.items() if k not in _CHAIN_ALIASES}
+    return docs
+
+
+# Memo ngắn hạn cho CẢ chain đã resolve: pipeline dual-sync (PG sync xong gọi
+# tiếp Neo sync với cùng bộ map) resolve lại y hệt trong vài giây — TTL ngắn
+# để doc sâu nhất không stale quá một nhịp request.
+_RESOLVED_CHAIN_TTL = 5.0
+_RESOLVED_CHAIN_CACHE_MAX = 1024
+_resolved_chain_cache: Dict[tuple, Tuple[float, tuple]] = {}
 
 
 def _resolve_chain_from_maps(
@@ -663,27 +1007,160 @@ def _resolve_chain_from_maps(
     lesson_map: str = "",
     chunk_map: str = "",
 ) -> Tuple[Optional[dict], Optional[dict], Optional[dict], Optional[dict], Optional[dict]]:
-    """Trả về (class_doc, subject_doc, topic_doc, lesson_doc, chunk_doc)"""
+    """Trả về (class_doc, subject_doc, topic_doc, lesson_doc, chunk_doc).
 
-    chunk_doc = _pick_by_map(db, "chunks", "chunkID", chunk_map) if chunk_map else None
-    if chunk_doc and not lesson_map:
-        lesson_map = _clean(chunk_doc.get("lessonID"))
+    Doc level sâu nhất luôn đọc tươi (1 find_one có projection); ancestor lấy
+    từ cache TTL, chỉ khi miss mới chạy 1 aggregation $lookup gộp từ level đó
+    lên hết chain. Map truyền tường minh vẫn thắng map suy ra từ doc cha.
+    Kết quả đầy đủ được memo vài giây cho các pipeline dual-sync.
+    """
+    cache_key = (class_map, subject_map, topic_map, lesson_map, chunk_map)
+    hit = _resolved_chain_cache.get(cache_key)
+    if hit is not None and hit[0] >= time.monotonic():
+        return hit[1]
+
+    maps = {
+        "chunks": chunk_map,
+        "lessons": lesson_map,
+        "topics": topic_map,
+        "subjects": subject_map,
+        "classes": class_map,
+    }
 
-    lesson_doc = _pick_by_map(db, "lessons", "lessonID", lesson_map) if lesson_map else None
-    if lesson_doc and not topic_map:
-        topic_map = _clean(lesson_doc.get("topicID"))
+    start = next((i for i, (col, *_rest) in enumerate(_CHAIN_LEVELS) if maps[col]), None)
+    if start is None:
+        return None, None, None, None, None
+
+    root_col, root_key, root_fk, root_alias = _CHAIN_LEVELS[start]
+    docs: Dict[str, Optional[dict]] = {alias: None for alias in _CHAIN_ALIASES}
+
+    root_doc = _pick_by_map(db, root_col, root_key, maps[root_col])
+    if root_doc is None:
+        # Doc gốc không tồn tại: bỏ map sâu nhất rồi thử lại từ level kế tiếp
+        # (giữ hành vi cũ: map tường minh ở level cao hơn vẫn được resolve).
+        maps[root_col] = ""
+        return _resolve_chain_from_maps(
+            db,
+            class_map=maps["classes"],
+            subject_map=maps["subjects"],
+            topic_map=maps["topics"],
+            lesson_map=maps["lessons"],
+            chunk_map=maps["chunks"],
+        )
+    docs[root_alias] = root_doc
+
+    # Đi ngược lên ancestor: ưu tiên cache; miss thì 1 aggregation từ level đó lên.
+    child_doc: Optional[dict] = root_doc
+    child_fk = root_fk
+    i = start + 1
+    while i < len(_CHAIN_LEVELS):
+        col, key, fk, alias = _CHAIN_LEVELS[i]
+        map_value = maps[col]
+        if not map_value and child_fk:
+            map_value = _clean((child_doc or {}).get(child_fk))
+        if not map_value:
+            child_doc, child_fk = None, fk
+            i += 1
+            continue
 
-    topic_doc = _pick_by_map(db, "topics", "topicID", topic_map) if topic_map else None
-    if topic_doc and not subject_map:
-        subject_map = _clean(topic_doc.get("subjectID"))
+        cached = _cached_chain_doc(col, map_value)
+        if cached is not None:
+            docs[alias] = cached
+            child_doc, child_fk = cached, fk
+            i += 1
+            continue
 
-    subject_doc = _pick_by_map(db, "subjects", "subjectID", subject_map) if subject_map else None
-    if subject_doc and not class_map:
-        class_map = _clean(subject_doc.get("classID"))
+        sub_maps = dict(maps)
+        sub_maps[col] = map_value
+        chain_docs = _aggregate_chain(db, i, sub_maps)
+        if chain_docs is None:
+            # level này không có doc => các level cao hơn chỉ còn map tường minh
+            child_doc, child_fk = None, fk
+            i += 1
+            continue
 
-    class_doc = _pick_by_map(db, "classes", "classID", class_map) if class_map else None
+        for col2, key2, _fk2, alias2 in _CHAIN_LEVELS[i:]:
+            d = chain_docs.get(alias2)
+            if d:
+                docs[alias2] = d
+                _remember_chain_doc(col2, _clean(d.get(key2)), d)
+        break
 
-    return class_doc, subject_doc, topic_doc, lesson_doc, chunk_doc
+    result = (docs["class"], docs["subject"], docs["topic"], docs["lesson"], docs["chunk"])
+    if len(_resolved_chain_cache) >= _RESOLVED_CHAIN_CACHE_MAX:
+        _resolved_chain_cache.clear()
+    _resolved_chain_cache[cache_key] = (time.monotonic() + _RESOLVED_CHAIN_TTL, result)
+    return result
+
+
+@dataclass(slots=True)
+class ChainDocs:
+    """Chuỗi doc đã resolve với field làm sạch sẵn (mỗi field _clean đúng 1 lần).
+
+    slots=True bỏ __dict__ per-instance; attribute access thay cho hàng chục
+    lần `(doc or {}).get(...)` rải rác ở các đường sync.
+    """
+
+    class_map: str
+    subject_map: str
+    topic_map: str
+    lesson_map: str
+    chunk_map: str
+    class_name: str
+    subject_name: str
+    topic_name: str
+    lesson_name: str
+    chunk_name: str
+    chunk_type: Optional[str]
+    mongo_class_id: Optional[str]
+    mongo_subject_id: Optional[str]
+    mongo_topic_id: Optional[str]
+    mongo_lesson_id: Optional[str]
+    mongo_chunk_id: Optional[str]
+    # raw doc giữ lại cho các đường đọc keyword (chunk_doc["keywords"] legacy...)
+    class_doc: Optional[dict]
+    subject_doc: Optional[dict]
+    topic_doc: Optional[dict]
+    lesson_doc: Optional[dict]
+    chunk_doc: Optional[dict]
+
+    @classmethod
+    def from_docs(
+        cls,
+        class_doc: Optional[dict],
+        subject_doc: Optional[dict],
+        topic_doc: Optional[dict],
+        lesson_doc: Optional[dict],
+        chunk_doc: Optional[dict],
+    ) -> "ChainDocs":
+        cd = class_doc or {}
+        sd = subject_doc or {}
+        td = topic_doc or {}
+        ld = lesson_doc or {}
+        kd = chunk_doc or {}
+        return cls(
+            class_map=_clean(cd.get("classID")),
+            subject_map=_clean(sd.get("subjectID")),
+            topic_map=_clean(td.get("topicID")),
+            lesson_map=_clean(ld.get("lessonID")),
+            chunk_map=_clean(kd.get("chunkID")),
+            class_name=_clean(cd.get("className")),
+            subject_name=_clean(sd.get("subjectName")),
+            topic_name=_clean(td.get("topicName")),
+            lesson_name=_clean(ld.get("lessonName")),
+            chunk_name=_clean(kd.get("chunkName")),
+            chunk_type=_extract_chunk_type(chunk_doc, lesson_doc),
+            mongo_class_id=str(cd["_id"]) if cd.get("_id") is not None else None,
+            mongo_subject_id=str(sd["_id"]) if sd.get("_id") is not None else None,
+            mongo_topic_id=str(td["_id"]) if td.get("_id") is not None else None,
+            mongo_lesson_id=str(ld["_id"]) if ld.get("_id") is not None else None,
+            mongo_chunk_id=str(kd["_id"]) if kd.get("_id") is not None else None,
+            class_doc=class_doc,
+            subject_doc=subject_doc,
+            topic_doc=topic_doc,
+            lesson_doc=lesson_doc,
+            chunk_doc=chunk_doc,
+        )
 
 
 def sync_postgre_from_mongo_maps(
@@ -714,38 +1191,38 @@ def sync_postgre_from_mongo_maps(
     mg = get_mongo_client()
     db = mg["db"]
 
-    class_doc, subject_doc, topic_doc, lesson_doc, chunk_doc = _resolve_chain_from_maps(
+    chain = ChainDocs.from_docs(*_resolve_chain_from_maps(
         db,
         class_map=class_map,
         subject_map=subject_map,
         topic_map=topic_map,
         lesson_map=lesson_map,
         chunk_map=chunk_map,
-    )
+    ))
 
     # fallback nếu không tìm thấy doc: dùng map làm tên
-    class_id = _clean((class_doc or {}).get("classID")) or class_map
-    subject_id = _clean((subject_doc or {}).get("subjectID")) or subject_map
-    topic_id = _clean((topic_doc or {}).get("topicID")) or topic_map
-    lesson_id = _clean((lesson_doc or {}).get("lessonID")) or lesson_map
-    chunk_id = _clean((chunk_doc or {}).get("chunkID")) or chunk_map
-
-    class_name = _clean((class_doc or {}).get("className")) or class_id
-    subject_name = _clean((subject_doc or {}).get("subjectName")) or subject_id
-    topic_name = _clean((topic_doc or {}).get("topicName")) or topic_id
-    lesson_name = _clean((lesson_doc or {}).get("lessonName")) or lesson_id
-    chunk_name = _clean((chunk_doc or {}).get("chunkName")) or chunk_id
-    chunk_type = _extract_chunk_type(chunk_doc, lesson_doc)
-
-    mongo_class_id = str((class_doc or {}).get("_id")) if class_doc else None
-    mongo_subject_id = str((subject_doc or {}).get("_id")) if subject_doc else None
-    mongo_topic_id = str((topic_doc or {}).get("_id")) if topic_doc else None
-    mongo_lesson_id = str((lesson_doc or {}).get("_id")) if lesson_doc else None
-    mongo_chunk_id = str((chunk_doc or {}).get("_id")) if chunk_doc else None
-
-    topic_map_for_number = topic_map or _clean((topic_doc or {}).get("topicID"))
-    lesson_map_for_number = lesson_map or _clean((lesson_doc or {}).get("lessonID"))
-    chunk_map_for_number = chunk_map or _clean((chunk_doc or {}).get("chunkID"))
+    class_id = chain.class_map or class_map
+    subject_id = chain.subject_map or subject_map
+    topic_id = chain.topic_map or topic_map
+    lesson_id = chain.lesson_map or lesson_map
+    chunk_id = chain.chunk_map or chunk_map
+
+    class_name = chain.class_name or class_id
+    subject_name = chain.subject_name or subject_id
+    topic_name = chain.topic_name or topic_id
+    lesson_name = chain.lesson_name or lesson_id
+    chunk_name = chain.chunk_name or chunk_id
+    chunk_type = chain.chunk_type
+
+    mongo_class_id = chain.mongo_class_id
+    mongo_subject_id = chain.mongo_subject_id
+    mongo_topic_id = chain.mongo_topic_id
+    mongo_lesson_id = chain.mongo_lesson_id
+    mongo_chunk_id = chain.mongo_chunk_id
+
+    topic_map_for_number = topic_map or chain.topic_map
+    lesson_map_for_number = lesson_map or chain.lesson_map
+    chunk_map_for_number = chunk_map or chain.chunk_map
 
     topic_number, lesson_number, chunk_number = _derive_hierarchy_numbers(
         topic_map=topic_map_for_number,
@@ -753,7 +1230,7 @@ def sync_postgre_from_mongo_maps(
         chunk_map=chunk_map_for_number,
     )
 
-    kw_docs = _get_keywords_for_chunk(db, chunk_map=chunk_map, chunk_doc=chunk_doc)
+    kw_docs = _get_keywords_for_chunk(db, chunk_map=chunk_map, chunk_doc=chain.chunk_doc)
 
     engine = get_engine()
 
@@ -765,109 +1242,95 @@ def sync_postgre_from_mongo_maps(
 
     keyword_ids: List[str] = []
 
-    with engine.begin() as conn:
-        if class_id:
-            conn.execute(
-                text(
-                    """
-                    INSERT INTO class (class_id, class_name, mongo_id)
-                    VALUES (:class_id, :class_name, :mongo_id)
-                    ON CONFLICT (class_id) DO UPDATE
-                    SET class_name = EXCLUDED.class_name,
-                        mongo_id   = COALESCE(EXCLUDED.mongo_id, class.mongo_id)
-                    """
-                ),
-                {"class_id": class_id, "class_name": class_name, "mongo_id": mongo_class_id},
-            )
-
-        if want_subject:
-            conn.execute(
-                text(
-                    """
-                    INSERT INTO subject (subject_id, subject_name, mongo_id, class_id)
-                    VALUES (:subject_id, :subject_name, :mongo_id, :class_id)
-                    ON CONFLICT (subject_id) DO UPDATE
-                    SET subject_name = EXCLUDED.subject_name,
-                        mongo_id     = COALESCE(EXCLUDED.mongo_id, subject.mongo_id),
-                        class_id     = EXCLUDED.class_id
-                    """
-                ),
+    content_hash: Optional[str] = None
+    if want_chunk:
+        content_hash = _chunk_content_hash({
+            "class_id": class_id,
+            "class_name": class_name,
+            "subject_id": subject_id,
+            "subject_name": subject_name,
+            "topic_id": topic_id,
+            "topic_name": topic_name,
+            "lesson_id": lesson_id,
+            "lesson_name": lesson_name,
+            "chunk_name": chunk_name,
+            "chunk_type": chunk_type,
+            "keywords": [
                 {
-                    "subject_id": subject_id,
-                    "subject_name": subject_name,
-                    "mongo_id": mongo_subject_id,
-                    "class_id": class_id or None,
-                },
+                    "keywordID": _clean(d.get("keywordID")),
+                    "keywordName": _clean(d.get("keywordName") or d.get("keyword_name") or d.get("name")),
+                    "mongo_id": str(d.get("_id")) if d.get("_id") is not None else None,
+                    "has_embedding": isinstance(d.get("keywordEmbedding"), list),
+                }
+                for d in kw_docs
+            ],
+        })
+        if _stored_chunk_hash(engine, chunk_id) == content_hash:
+            # Nội dung không đổi so với lần sync trước => bỏ qua toàn bộ upsert.
+            kw_hash_id = _keyword_id_hasher(chunk_id)
+            keyword_ids = list(dict.fromkeys(
+                _clean(d.get("keywordID")) or kw_hash_id(kw_name)
+                for kw_name, d in _dedupe_keyword_docs(kw_docs)
+            ))
+            return PgIds(
+                class_id=class_id or "",
+                subject_id=subject_id or "",
+                topic_id=topic_id or "",
+                lesson_id=lesson_id or "",
+                chunk_id=chunk_id or "",
+                keyword_ids=keyword_ids,
             )
 
-        if want_topic:
-            _upsert_topic(
-                conn,
-                topic_id=topic_id,
-                topic_name=topic_name,
-                mongo_id=mongo_topic_id,
-                subject_id=subject_id or None,
-                topic_number=topic_number,
-            )
+    chain_levels: List[Tuple[str, dict]] = []
+    if class_id:
+        chain_levels.append(("class", {
+            "class_id": class_id,
+            "class_name": class_name,
+            "class_mongo_id": mongo_class_id,
+        }))
+    if want_subject:
+        chain_levels.append(("subject", {
+            "subject_id": subject_id,
+            "subject_name": subject_name,
+            "subject_mongo_id": mongo_subject_id,
+            "subject_class_id": class_id or None,
+        }))
+    if want_topic:
+        chain_levels.append(("topic", {
+            "topic_id": topic_id,
+            "topic_name": topic_name,
+            "topic_mongo_id": mongo_topic_id,
+            "topic_subject_id": subject_id or None,
+            "topic_number": topic_number,
+        }))
+    if want_lesson:
+        chain_levels.append(("lesson", {
+            "lesson_id": lesson_id,
+            "lesson_name": lesson_name,
+            "lesson_mongo_id": mongo_lesson_id,
+            "lesson_topic_id": topic_id or None,
+            "lesson_number": lesson_number,
+        }))
+    if want_chunk:
+        chain_levels.append(("chunk", {
+            "chunk_id": chunk_id,
+            "chunk_name": chunk_name,
+            "chunk_type": chunk_type or None,
+            "chunk_mongo_id": mongo_chunk_id,
+            "chunk_lesson_id": lesson_id or None,
+            "chunk_number": chunk_number,
+            "content_hash": content_hash,
+        }))
 
-        if want_lesson:
-            _upsert_lesson(
-                conn,
-                lesson_id=lesson_id,
-                lesson_name=lesson_name,
-                mongo_id=mongo_lesson_id,
-                topic_id=topic_id or None,
-                lesson_number=lesson_number,
-            )
+    # keywords: hash + embedding tính ngoài transaction (diff sync bên trong)
+    keyword_rows = _build_chunk_keyword_rows(chunk_id, kw_docs) if want_chunk else []
 
-        if want_chunk:
-            _upsert_chunk(
-                conn,
-                chunk_id=chunk_id,
-                chunk_name=chunk_name,
-                chunk_type=chunk_type or None,
-                mongo_id=mongo_chunk_id,
-                lesson_id=lesson_id or None,
-                chunk_number=chunk_number,
-            )
+    with engine.begin() as conn:
+        chain_fps = _upsert_chain_by_map(conn, chain_levels)
 
-            # keywords: xoá cũ rồi insert lại
-            conn.execute(text("DELETE FROM keyword WHERE map_id = :map_id"), {"map_id": chunk_id})
-
-            for d in kw_docs:
-                kw_name = _clean(d.get("keywordName") or d.get("keyword_name") or d.get("name"))
-                if not kw_name:
-                    continue
-                kw_id = _clean(d.get("keywordID")) or _sha384_96(f"{chunk_id}:{kw_name}")
-                keyword_ids.append(kw_id)
-
-                mongo_kw_id = str(d.get("_id")) if d.get("_id") is not None else None
-                kw_emb = d.get("keywordEmbedding")
-                if kw_emb is not None and not isinstance(kw_emb, list):
-                    kw_emb = None
-                if kw_emb is None:
-                    kw_emb = embed_keyword_cached(kw_name)
-
-                conn.execute(
-                    text(
-                        """
-                        INSERT INTO keyword (keyword_id, keyword_name, keyword_embedding, mongo_id, map_id)
-                        VALUES (:keyword_id, :keyword_name, :keyword_embedding, :mongo_id, :map_id)
-                        ON CONFLICT (keyword_id) DO UPDATE
-                        SET keyword_name      = EXCLUDED.keyword_name,
-                            keyword_embedding = COALESCE(EXCLUDED.keyword_embedding, keyword.keyword_embedding),
-                            mongo_id          = COALESCE(EXCLUDED.mongo_id, keyword.mongo_id),
-                            map_id            = EXCLUDED.map_id
-                        """
-                    ),
-                    {
-                        "keyword_id": kw_id,
-                        "keyword_name": kw_name,
-                        "keyword_embedding": kw_emb,
-                        "mongo_id": mongo_kw_id,
-                        "chunk_id": actual_chunk_id,
-                    },
-                )
+        if want_chunk:
+            keyword_ids = _refresh_keyword_rows(conn, keyword_rows, [chunk_id])
+    _record_synced_levels(chain_fps)
 
     return PgIds(
         class_id=class_id or "",
@@ -879,6 +1342,242 @@ def sync_postgre_from_mongo_maps(
     )
 
 
+def _pick_many_by_map(db, col: str, map_key: str, map_values: List[str]) -> Dict[str, dict]:
+    """Bản batched của _pick_by_map: 1 find với $in thay vì N find_one."""
+    values = [v for v in map_values if v]
+    if not values:
+        return {}
+    cursor = db[col].find({map_key: {"$in": values}}, projection=_SYNC_PROJECTIONS.get(col))
+    return {_clean(doc.get(map_key)): doc for doc in cursor}
+
+
+def _get_keywords_for_chunks(
+    db, chunk_maps: List[str], chunk_doc_by_map: Dict[str, dict]
+) -> Dict[str, List[dict]]:
+    """Bản batched của _get_keywords_for_chunk: 1 query $in cho cả lô chunk."""
+    out: Dict[str, List[dict]] = {m: [] for m in chunk_maps}
+    if chunk_maps:
+        try:
+            cursor = (
+                db["keywords"]
+                .find({"chunkID": {"$in": list(chunk_maps)}}, projection=_KEYWORD_PROJECTION)
+                .sort("keywordID", 1)
+            )
+            for doc in cursor:
+                out.setdefault(_clean(doc.get("chunkID")), []).append(doc)
+        except Exception:
+            pass
+    for m in chunk_maps:
+        if not out[m]:
+            # legacy fallback: chunk_doc["keywords"] (chunk_map rỗng => bỏ qua query)
+            out[m] = _get_keywords_for_chunk(db, chunk_map="", chunk_doc=chunk_doc_by_map.get(m))
+    return out
+
+
+def sync_postgre_from_mongo_maps_many(chunk_maps: List[str]) -> List[PgIds]:
+    """Sync hàng loạt chunk theo map ID với số round-trip gần như hằng số.
+
+    Thay vì gọi sync_postgre_from_mongo_maps trong vòng lặp (5*N query Mongo +
+    N transaction PG), mỗi level chạy đúng 1 query $in trên toàn lô và toàn bộ
+    ghi PG gói trong 1 transaction. Kết quả trả theo thứ tự chunk_maps đầu vào
+    (đã lọc rỗng + trùng).
+    """
+    ensure_postgre_search_columns()
+
+    ordered: List[str] = []
+    seen = set()
+    for m in chunk_maps:
+        clean = _clean(m)
+        if clean and clean not in seen:
+            seen.add(clean)
+            ordered.append(clean)
+    if not ordered:
+        return []
+
+    mg = get_mongo_client()
+    db = mg["db"]
+
+    # fan-out theo level: gom FK của lô rồi 1 query $in / collection
+    chunk_by_map = _pick_many_by_map(db, "chunks", "chunkID", ordered)
+
+    engine = get_engine()
+    # chunk_id đích chỉ phụ thuộc chunk_doc => biết trước lô id cần pre-read hash
+    chunk_ids = [_clean((chunk_by_map.get(m) or {}).get("chunkID")) or m for m in ordered]
+
+    def _read_stored_hashes() -> Dict[str, Optional[str]]:
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as read_conn:
+            return dict(
+                read_conn.execute(
+                    text("SELECT chunk_id, content_hash FROM chunk WHERE chunk_id = ANY(:ids)"),
+                    {"ids": chunk_ids},
+                ).fetchall()
+            )
+
+    # Query keywords (Mongo) và hash đã lưu (PG) không phụ thuộc fan-out
+    # ancestor => đẩy sang worker thread chạy chồng lên các query phía dưới
+    # (MongoClient lẫn Engine đều thread-safe). Tương đương asyncio.gather
+    # của bản driver async nhưng không phải đổi cả stack pymongo/psycopg2.
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        kw_future = pool.submit(_get_keywords_for_chunks, db, ordered, chunk_by_map)
+        hash_future = pool.submit(_read_stored_hashes)
+
+        lesson_maps = sorted({_clean(d.get("lessonID")) for d in chunk_by_map.values()} - {""})
+        lesson_by_map = _pick_many_by_map(db, "lessons", "lessonID", lesson_maps)
+        topic_maps = sorted({_clean(d.get("topicID")) for d in lesson_by_map.values()} - {""})
+        topic_by_map = _pick_many_by_map(db, "topics", "topicID", topic_maps)
+        subject_maps = sorted({_clean(d.get("subjectID")) for d in topic_by_map.values()} - {""})
+        subject_by_map = _pick_many_by_map(db, "subjects", "subjectID", subject_maps)
+        class_maps = sorted({_clean(d.get("classID")) for d in subject_by_map.values()} - {""})
+        class_by_map = _pick_many_by_map(db, "classes", "classID", class_maps)
+
+        kw_docs_by_map = kw_future.result()
+        stored_hashes = hash_future.result()
+
+    # dựng trạng thái đích cho từng chunk (cùng quy tắc với sync đơn lẻ)
+    prepared: List[dict] = []
+    for chunk_map in ordered:
+        chunk_doc = chunk_by_map.get(chunk_map)
+        lesson_map = _clean((chunk_doc or {}).get("lessonID"))
+        lesson_doc = lesson_by_map.get(lesson_map)
+        topic_map = _clean((lesson_doc or {}).get("topicID"))
+        topic_doc = topic_by_map.get(topic_map)
+        subject_map = _clean((topic_doc or {}).get("subjectID"))
+        subject_doc = subject_by_map.get(subject_map)
+        class_map = _clean((subject_doc or {}).get("classID"))
+        class_doc = class_by_map.get(class_map)
+
+        chain = ChainDocs.from_docs(class_doc, subject_doc, topic_doc, lesson_doc, chunk_doc)
+        chunk_id = chain.chunk_map or chunk_map
+        kw_docs = kw_docs_by_map.get(chunk_map) or []
+
+        item = {
+            "chunk_map": chunk_map,
+            "class_id": chain.class_map or class_map,
+            "subject_id": chain.subject_map or subject_map,
+            "topic_id": chain.topic_map or topic_map,
+            "lesson_id": chain.lesson_map or lesson_map,
+            "chunk_id": chunk_id,
+            "class_name": chain.class_name or class_map,
+            "subject_name": chain.subject_name or subject_map,
+            "topic_name": chain.topic_name or topic_map,
+            "lesson_name": chain.lesson_name or lesson_map,
+            "chunk_name": chain.chunk_name or chunk_id,
+            "chunk_type": chain.chunk_type,
+            "mongo_class_id": chain.mongo_class_id,
+            "mongo_subject_id": chain.mongo_subject_id,
+            "mongo_topic_id": chain.mongo_topic_id,
+            "mongo_lesson_id": chain.mongo_lesson_id,
+            "mongo_chunk_id": chain.mongo_chunk_id,
+            "kw_docs": kw_docs,
+        }
+        item["numbers"] = _derive_hierarchy_numbers(
+            topic_map=topic_map, lesson_map=lesson_map, chunk_map=chunk_map
+        )
+        item["content_hash"] = _chunk_content_hash({
+            "class_id": item["class_id"],
+            "class_name": item["class_name"],
+            "subject_id": item["subject_id"],
+            "subject_name": item["subject_name"],
+            "topic_id": item["topic_id"],
+            "topic_name": item["topic_name"],
+            "lesson_id": item["lesson_id"],
+            "lesson_name": item["lesson_name"],
+            "chunk_name": item["chunk_name"],
+            "chunk_type": item["chunk_type"],
+            "keywords": [
+                {
+                    "keywordID": _clean(d.get("keywordID")),
+                    "keywordName": _clean(d.get("keywordName") or d.get("keyword_name") or d.get("name")),
+                    "mongo_id": str(d.get("_id")) if d.get("_id") is not None else None,
+                    "has_embedding": isinstance(d.get("keywordEmbedding"), list),
+                }
+                for d in kw_docs
+            ],
+        })
+        prepared.append(item)
+
+    # stored_hashes đã pre-read song song ở trên: hash trùng => bỏ qua hoàn toàn
+    results: List[PgIds] = []
+    changed: List[dict] = []
+    for item in prepared:
+        kw_hash_id = _keyword_id_hasher(item["chunk_id"])
+        keyword_ids = list(dict.fromkeys(
+            _clean(d.get("keywordID")) or kw_hash_id(kw_name)
+            for kw_name, d in _dedupe_keyword_docs(item["kw_docs"])
+        ))
+        results.append(PgIds(
+            class_id=item["class_id"],
+            subject_id=item["subject_id"],
+            topic_id=item["topic_id"],
+            lesson_id=item["lesson_id"],
+            chunk_id=item["chunk_id"],
+            keyword_ids=keyword_ids,
+        ))
+        if stored_hashes.get(item["chunk_id"]) != item["content_hash"]:
+            changed.append(item)
+
+    if not changed:
+        return results
+
+    # hash + embedding cho chunk thay đổi: tính hết NGOÀI transaction
+    all_keyword_rows: List[dict] = []
+    for item in changed:
+        all_keyword_rows.extend(_build_chunk_keyword_rows(item["chunk_id"], item["kw_docs"]))
+
+    chain_fps: List[str] = []
+    in_tx_fps: set = set()
+    with engine.begin() as conn:
+        for item in changed:
+            topic_number, lesson_number, chunk_number = item["numbers"]
+            chain_levels: List[Tuple[str, dict]] = []
+            if item["class_id"]:
+                chain_levels.append(("class", {
+                    "class_id": item["class_id"],
+                    "class_name": item["class_name"],
+                    "class_mongo_id": item["mongo_class_id"],
+                }))
+            if item["subject_id"]:
+                chain_levels.append(("subject", {
+                    "subject_id": item["subject_id"],
+                    "subject_name": item["subject_name"],
+                    "subject_mongo_id": item["mongo_subject_id"],
+                    "subject_class_id": item["class_id"] or None,
+                }))
+            if item["topic_id"]:
+                chain_levels.append(("topic", {
+                    "topic_id": item["topic_id"],
+                    "topic_name": item["topic_name"],
+                    "topic_mongo_id": item["mongo_topic_id"],
+                    "topic_subject_id": item["subject_id"] or None,
+                    "topic_number": topic_number,
+                }))
+            if item["lesson_id"]:
+                chain_levels.append(("lesson", {
+                    "lesson_id": item["lesson_id"],
+                    "lesson_name": item["lesson_name"],
+                    "lesson_mongo_id": item["mongo_lesson_id"],
+                    "lesson_topic_id": item["topic_id"] or None,
+                    "lesson_number": lesson_number,
+                }))
+            chain_levels.append(("chunk", {
+                "chunk_id": item["chunk_id"],
+                "chunk_name": item["chunk_name"],
+                "chunk_type": item["chunk_type"] or None,
+                "chunk_mongo_id": item["mongo_chunk_id"],
+                "chunk_lesson_id": item["lesson_id"] or None,
+                "chunk_number": chunk_number,
+                "content_hash": item["content_hash"],
+            }))
+            # ancestor trùng giữa các chunk trong lô bị lược nhờ in_tx_fps
+            chain_fps.extend(_upsert_chain_by_map(conn, chain_levels, in_tx_fps=in_tx_fps))
+
+        # keyword_id luôn mang prefix chunk_id nên prune gộp cho cả lô là an toàn
+        _refresh_keyword_rows(conn, all_keyword_rows, [item["chunk_id"] for item in changed])
+    _record_synced_levels(chain_fps)
+
+    return results
+
+
 # ======================================================================================
 # 3) MỚI: sync theo MAP nhưng Postgre lưu ID chuẩn mới (KHÔNG lưu map id)
 #
@@ -910,33 +1609,33 @@ def sync_postgre_from_mongo_auto_ids(
     mg = get_mongo_client()
     db = mg["db"]
 
-    class_doc, subject_doc, topic_doc, lesson_doc, chunk_doc = _resolve_chain_from_maps(
+    chain = ChainDocs.from_docs(*_resolve_chain_from_maps(
         db,
         class_map=class_map,
         subject_map=subject_map,
         topic_map=topic_map,
         lesson_map=lesson_map,
         chunk_map=chunk_map,
-    )
-
-    class_map = class_map or _clean((class_doc or {}).get("classID"))
-    subject_map = subject_map or _clean((subject_doc or {}).get("subjectID"))
-    topic_map = topic_map or _clean((topic_doc or {}).get("topicID"))
-    lesson_map = lesson_map or _clean((lesson_doc or {}).get("lessonID"))
-    chunk_map = chunk_map or _clean((chunk_doc or {}).get("chunkID"))
-
-    class_name = _clean((class_doc or {}).get("className")) or class_map
-    subject_name = _clean((subject_doc or {}).get("subjectName")) or subject_map
-    topic_name = _clean((topic_doc or {}).get("topicName")) or (topic_map or "")
-    lesson_name = _clean((lesson_doc or {}).get("lessonName")) or (lesson_map or "")
-    chunk_name = _clean((chunk_doc or {}).get("chunkName")) or (chunk_map or "")
-    chunk_type = _extract_chunk_type(chunk_doc, lesson_doc)
-
-    mongo_class_id = str((class_doc or {}).get("_id")) if class_doc else None
-    mongo_subject_id = str((subject_doc or {}).get("_id")) if subject_doc else None
-    mongo_topic_id = str((topic_doc or {}).get("_id")) if topic_doc else None
-    mongo_lesson_id = str((lesson_doc or {}).get("_id")) if lesson_doc else None
-    mongo_chunk_id = str((chunk_doc or {}).get("_id")) if chunk_doc else None
+    ))
+
+    class_map = class_map or chain.class_map
+    subject_map = subject_map or chain.subject_map
+    topic_map = topic_map or chain.topic_map
+    lesson_map = lesson_map or chain.lesson_map
+    chunk_map = chunk_map or chain.chunk_map
+
+    class_name = chain.class_name or class_map
+    subject_name = chain.subject_name or subject_map
+    topic_name = chain.topic_name or (topic_map or "")
+    lesson_name = chain.lesson_name or (lesson_map or "")
+    chunk_name = chain.chunk_name or (chunk_map or "")
+    chunk_type = chain.chunk_type
+
+    mongo_class_id = chain.mongo_class_id
+    mongo_subject_id = chain.mongo_subject_id
+    mongo_topic_id = chain.mongo_topic_id
+    mongo_lesson_id = chain.mongo_lesson_id
+    mongo_chunk_id = chain.mongo_chunk_id
 
     class_id = _class_id_from_class_map(class_map, class_name)
     subject_id = _normalize_subject_id(subject_map, class_id=class_id, subject_name=subject_name)
@@ -962,18 +1661,19 @@ def sync_postgre_from_mongo_auto_ids(
             lesson_id = lesson_id or f"{topic_id}_L{lnum}"
             chunk_id = f"{lesson_id}_C{cnum}"
 
+    # topic_map/lesson_map/chunk_map đã được fill từ chain ở trên
     topic_number, lesson_number, chunk_number = _derive_hierarchy_numbers(
-        topic_map=topic_map or _clean((topic_doc or {}).get("topicID")),
-        lesson_map=lesson_map or _clean((lesson_doc or {}).get("lessonID")),
-        chunk_map=chunk_map or _clean((chunk_doc or {}).get("chunkID")),
+        topic_map=topic_map,
+        lesson_map=lesson_map,
+        chunk_map=chunk_map,
     )
 
     keyword_payloads = _collect_hierarchy_keyword_payloads(
         db,
-        subject_doc=subject_doc,
-        topic_doc=topic_doc,
-        lesson_doc=lesson_doc,
-        chunk_doc=chunk_doc,
+        subject_doc=chain.subject_doc,
+        topic_doc=chain.topic_doc,
+        lesson_doc=chain.lesson_doc,
+        chunk_doc=chain.chunk_doc,
         subject_id=subject_id,
         topic_id=topic_id,
         lesson_id=lesson_id,
@@ -988,77 +1688,92 @@ def sync_postgre_from_mongo_auto_ids(
     want_lesson = bool(lesson_id)
     want_chunk = bool(chunk_id)
 
-    with engine.begin() as conn:
-        if class_id:
-            conn.execute(
-                text(
-                    """
-                    INSERT INTO class (class_id, class_name, mongo_id)
-                    VALUES (:class_id, :class_name, :mongo_id)
-                    ON CONFLICT (class_id) DO UPDATE
-                    SET class_name = EXCLUDED.class_name,
-                        mongo_id   = COALESCE(EXCLUDED.mongo_id, class.mongo_id)
-                    """
-                ),
-                {"class_id": class_id, "class_name": class_name, "mongo_id": mongo_class_id},
-            )
-
-        if want_subject:
-            conn.execute(
-                text(
-                    """
-                    INSERT INTO subject (subject_id, subject_name, mongo_id, class_id)
-                    VALUES (:subject_id, :subject_name, :mongo_id, :class_id)
-                    ON CONFLICT (subject_id) DO UPDATE
-                    SET subject_name = EXCLUDED.subject_name,
-                        mongo_id     = COALESCE(EXCLUDED.mongo_id, subject.mongo_id),
-                        class_id     = EXCLUDED.class_id
-                    """
-                ),
+    content_hash: Optional[str] = None
+    if want_chunk:
+        # Fingerprint gồm cả keyword payload của subject/topic/lesson (auto sync
+        # ghi keyword cho mọi level) nhưng bỏ embedding: cùng tên => cùng embedding.
+        content_hash = _chunk_content_hash({
+            "class_id": class_id,
+            "class_name": class_name,
+            "subject_id": subject_id,
+            "subject_name": subject_name,
+            "topic_id": topic_id,
+            "topic_name": topic_name,
+            "lesson_id": lesson_id,
+            "lesson_name": lesson_name,
+            "chunk_name": chunk_name,
+            "chunk_type": chunk_type,
+            "keywords": [
                 {
-                    "subject_id": subject_id,
-                    "subject_name": subject_name or subject_id,
-                    "mongo_id": mongo_subject_id,
-                    "class_id": class_id or None,
-                },
-            )
-
-        if want_topic:
-            _upsert_topic(
-                conn,
-                topic_id=topic_id,
-                topic_name=topic_name or topic_id,
-                mongo_id=mongo_topic_id,
-                subject_id=subject_id,
-                topic_number=topic_number,
+                    "keyword_id": item["keyword_id"],
+                    "keyword_name": item["keyword_name"],
+                    "mongo_id": item["mongo_id"],
+                    "map_id": item["map_id"],
+                }
+                for item in keyword_payloads
+            ],
+        })
+        if _stored_chunk_hash(engine, chunk_id) == content_hash:
+            # Nội dung không đổi so với lần sync trước => bỏ qua toàn bộ upsert.
+            return PgIds(
+                class_id=class_id or "",
+                subject_id=subject_id or "",
+                topic_id=topic_id or "",
+                lesson_id=lesson_id or "",
+                chunk_id=chunk_id or "",
+                keyword_ids=[item["keyword_id"] for item in keyword_payloads],
             )
 
-        if want_lesson:
-            _upsert_lesson(
-                conn,
-                lesson_id=lesson_id,
-                lesson_name=lesson_name or lesson_id,
-                mongo_id=mongo_lesson_id,
-                topic_id=topic_id,
-                lesson_number=lesson_number,
-            )
+    chain_levels: List[Tuple[str, dict]] = []
+    if class_id:
+        chain_levels.append(("class", {
+            "class_id": class_id,
+            "class_name": class_name,
+            "class_mongo_id": mongo_class_id,
+        }))
+    if want_subject:
+        chain_levels.append(("subject", {
+            "subject_id": subject_id,
+            "subject_name": subject_name or subject_id,
+            "subject_mongo_id": mongo_subject_id,
+            "subject_class_id": class_id or None,
+        }))
+    if want_topic:
+        chain_levels.append(("topic", {
+            "topic_id": topic_id,
+            "topic_name": topic_name or topic_id,
+            "topic_mongo_id": mongo_topic_id,
+            "topic_subject_id": subject_id,
+            "topic_number": topic_number,
+        }))
+    if want_lesson:
+        chain_levels.append(("lesson", {
+            "lesson_id": lesson_id,
+            "lesson_name": lesson_name or lesson_id,
+            "lesson_mongo_id": mongo_lesson_id,
+            "lesson_topic_id": topic_id,
+            "lesson_number": lesson_number,
+        }))
+    if want_chunk:
+        chain_levels.append(("chunk", {
+            "chunk_id": chunk_id,
+            "chunk_name": chunk_name or chunk_id,
+            "chunk_type": chunk_type or None,
+            "chunk_mongo_id": mongo_chunk_id,
+            "chunk_lesson_id": lesson_id,
+            "chunk_number": chunk_number,
+            "content_hash": content_hash,
+        }))
 
-        if want_chunk:
-            _upsert_chunk(
-                conn,
-                chunk_id=chunk_id,
-                chunk_name=chunk_name or chunk_id,
-                chunk_type=chunk_type or None,
-                mongo_id=mongo_chunk_id,
-                lesson_id=lesson_id,
-                chunk_number=chunk_number,
-            )
+    with engine.begin() as conn:
+        chain_fps = _upsert_chain_by_map(conn, chain_levels)
 
         keyword_ids = _refresh_keyword_rows(
             conn,
             keyword_payloads,
             [subject_id, topic_id, lesson_id, chunk_id],
         )
+    _record_synced_levels(chain_fps)
 
     return PgIds(
         class_id=class_id or "",
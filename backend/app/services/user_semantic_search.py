@@ -1,20 +1,26 @@
 from __future__ import annotations
 
+import heapq
 import math
 import time
 import re
 import unicodedata
+from dataclasses import dataclass
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from typing import Dict, List, Optional, Tuple
 
+import numpy as np
+
 from bson import ObjectId
-from sqlalchemy import and_, or_, select
+from sqlalchemy import and_, func, or_, select, exists
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.orm import Session
 
 from ..models.model_postgre import Chunk, Class, Image, Keyword, Lesson, Subject, Topic, Video
 from .gemini_topic_expander import expand_topic_keywords_debug
-from .keyword_embedding import embed_keyword_cached
+from .keyword_embedding import embed_keyword_cached, embed_keywords_batch
 
 _TOKEN_RE = re.compile(r"[0-9A-Za-zÀ-ỹ]+", flags=re.UNICODE)
 _SERVICE_VERSION = "search_hierarchical_keyword_neo4j_branch_gate_v7_exact_pg_id"
@@ -37,12 +43,14 @@ _STOP = {
 # --------------------------- basic text utils ---------------------------
 
 def _norm_spaces(s: str) -> str:
-    return re.sub(r"\s+", " ", (s or "").strip())
+    # split() đã tách theo mọi whitespace và bỏ chuỗi rỗng => join lại là
+    # collapse + strip trong 1 vòng quét C, khỏi cần máy trạng thái regex
+    return " ".join((s or "").split())
 
 
 def _normalize_for_phrase_strip(text: str) -> str:
-    s = _norm_spaces((text or "").lower())
-    return re.sub(r"\s+", " ", s).strip()
+    # _norm_spaces đã collapse + strip xong; không cần thêm lượt regex nào nữa
+    return _norm_spaces((text or "").lower())
 
 
 def _strip_query_filler_phrases(text: str) -> str:
@@ -63,37 +71,48 @@ def _strip_query_filler_phrases(text: str) -> str:
     return _norm_spaces(s)
 
 
-def _tokens_no_stop(q: str) -> List[str]:
-    raw = [t.lower() for t in _TOKEN_RE.findall(q or "") if t]
-    return [t for t in raw if len(t) >= 2 and t not in _STOP]
+# Bảng translate dựng 1 lần: ký tự ASCII không alnum -> khoảng trắng. Với input
+# thuần ASCII, translate + split là 1 vòng quét C, khỏi chạy máy trạng thái
+# regex; query có dấu tiếng Việt (non-ASCII) rơi về _TOKEN_RE như cũ.
+_ASCII_TOKEN_TABLE = str.maketrans({chr(c): " " for c in range(128) if not chr(c).isalnum()})
+
+
+# Các helper text chạy lại trên cùng chuỗi rất nhiều lần mỗi request (mỗi
+# keyword name qua mọi gate, query qua mọi tầng) và giữa các request vì người
+# dùng hay search lặp => memo theo đúng chuỗi input bằng lru_cache.
+@lru_cache(maxsize=8192)
+def _tokens_no_stop(q: str) -> Tuple[str, ...]:
+    s = q or ""
+    if s.isascii():
+        raw = s.lower().translate(_ASCII_TOKEN_TABLE).split()
+    else:
+        raw = [t.lower() for t in _TOKEN_RE.findall(s) if t]
+    return tuple(t for t in raw if len(t) >= 2 and t not in _STOP)
 
 
 def _core_query_text(q: str) -> str:
     return _norm_spaces(" ".join(_tokens_no_stop(q)))
 
 
+# dict giữ thứ tự chèn từ 3.7 => tự nó là "insertion-order set": một cấu trúc
+# duy nhất thay cho cặp list + set (mỗi phần tử chỉ 1 lần hash thay vì 2).
+
 def _dedupe_keep_order_text(values: List[str]) -> List[str]:
-    out: List[str] = []
-    seen: set[str] = set()
+    out: Dict[str, None] = {}
     for value in values:
         clean = _norm_spaces(str(value or "").lower())
-        if not clean or clean in seen:
-            continue
-        seen.add(clean)
-        out.append(clean)
-    return out
+        if clean:
+            out.setdefault(clean)
+    return list(out)
 
 
 def _dedupe_keep_order_ids(values: List[str]) -> List[str]:
-    out: List[str] = []
-    seen: set[str] = set()
+    out: Dict[str, None] = {}
     for value in values:
         clean = _norm_spaces(str(value or ""))
-        if not clean or clean in seen:
-            continue
-        seen.add(clean)
-        out.append(clean)
-    return out
+        if clean:
+            out.setdefault(clean)
+    return list(out)
 
 
 def _collect_ids_keep_case(rows: List[dict], key: str) -> List[str]:
@@ -115,6 +134,7 @@ def _clean_hint_text(segment: str) -> str:
     return _core_query_text(text)
 
 
+@lru_cache(maxsize=4096)
 def _strip_keyword_filler(text: str) -> str:
     return _core_query_text(_strip_query_filler_phrases(text))
 
@@ -125,6 +145,7 @@ def _strip_accents(text: str) -> str:
     return s.replace("đ", "d").replace("Đ", "D")
 
 
+@lru_cache(maxsize=8192)
 def _norm_keyword_text(text: str) -> str:
     base = _strip_query_filler_phrases(text)
     base = _strip_accents(base)
@@ -185,20 +206,170 @@ def _expand_ids_for_aliases(ids_by_alias: Dict[str, List[str]], aliases: List[st
 # --------------------------- similarity ---------------------------
 
 def _cosine(a: List[float], b: List[float]) -> float:
-    if not a or not b:
+    # np.dot/np.vdot chạy trên kernel BLAS thay vì vòng lặp Python từng float;
+    # với hàng nghìn cặp (keyword x query) mỗi request thì vòng lặp cũ chiếm CPU.
+    if a is None or b is None or len(a) == 0 or len(b) == 0:
         return 0.0
-    n = min(len(a), len(b))
-    dot = 0.0
-    na = 0.0
-    nb = 0.0
-    for i in range(n):
-        x = float(a[i])
-        y = float(b[i])
-        dot += x * y
-        na += x * x
-        nb += y * y
-    den = math.sqrt(na) * math.sqrt(nb)
-    return float(dot / den) if den > 0 else 0.0
+    x = np.asarray(a, dtype=np.float32)
+    y = np.asarray(b, dtype=np.float32)
+    n = min(x.shape[0], y.shape[0])
+    if x.shape[0] != n:
+        x = x[:n]
+    if y.shape[0] != n:
+        y = y[:n]
+    den = math.sqrt(float(np.vdot(x, x)) * float(np.vdot(y, y)))
+    return float(np.dot(x, y)) / den if den > 0 else 0.0
+
+
+# Embedding keyword gần như bất biến giữa các lần sync => chuẩn hoá L2 một lần
+# rồi cache vector đơn vị float32 theo keyword_id; cosine rút về phép dot thuần
+# và các request sau khỏi trả chi phí list->ndarray + sqrt cho cùng keyword.
+# Dừng ở float32, không lượng tử hoá int8: các ngưỡng keep_ratio/floor phía
+# scoring tune theo cosine fp32 (chênh 0.01 là đổi kết quả lọc), và không có
+# kernel i8 dot nào sẵn trong stack hiện tại để đổi lấy sai số đó.
+_NORM_EMB_TTL = 600.0
+_NORM_EMB_CACHE_MAX = 50_000
+_norm_emb_cache: Dict[str, Tuple[float, np.ndarray]] = {}
+
+
+def _normalized_embedding(keyword_id: str, emb: List[float]) -> np.ndarray:
+    now = time.monotonic()
+    hit = _norm_emb_cache.get(keyword_id) if keyword_id else None
+    if hit is not None and hit[0] > now and hit[1].shape[0] == len(emb):
+        return hit[1]
+    v = np.asarray(emb, dtype=np.float32)
+    norm = math.sqrt(float(np.vdot(v, v)))
+    v = v / norm if norm > 0 else np.zeros_like(v)
+    if keyword_id:
+        if len(_norm_emb_cache) >= _NORM_EMB_CACHE_MAX:
+            _norm_emb_cache.clear()
+        _norm_emb_cache[keyword_id] = (now + _NORM_EMB_TTL, v)
+    return v
+
+
+# Ma trận đơn vị (N,d) stack từ cùng một tập keyword bị dựng lại mỗi lần chấm
+# điểm dù row scope đã cache (TTL 60s) => memo bản stack theo (dim, tuple
+# keyword_id). Cache hit biến bước "deserialize + stack" thành một lần tra
+# dict; TTL theo cache chuẩn hoá để embedding mới sau sync vẫn được nhận.
+_STACK_TTL = _NORM_EMB_TTL
+_STACK_CACHE_MAX = 64
+_stack_cache: Dict[Tuple[int, Tuple[str, ...]], Tuple[float, np.ndarray]] = {}
+
+
+def _stacked_unit_matrix(dim: int, idxs: List[int], rows: List[Tuple[str, str, str, List[float]]]) -> np.ndarray:
+    key = (dim, tuple(rows[i][0] for i in idxs))
+    now = time.monotonic()
+    hit = _stack_cache.get(key)
+    if hit is not None and hit[0] > now:
+        return hit[1]
+    matrix = np.asarray([_normalized_embedding(rows[i][0], rows[i][3]) for i in idxs], dtype=np.float32)
+    if len(_stack_cache) >= _STACK_CACHE_MAX:
+        _stack_cache.clear()
+    _stack_cache[key] = (now + _STACK_TTL, matrix)
+    return matrix
+
+
+def _cosine_scores_for_rows(
+    query_embedding: List[float],
+    rows: List[Tuple[str, str, str, List[float]]],
+) -> List[float]:
+    """Cosine của query với embedding mọi row bằng 1 matmul thay vì N lần _cosine.
+
+    Gom các vector đơn vị cùng chiều (từ cache chuẩn hoá) vào một ma trận
+    float32 rồi `E @ q_chuẩn_hoá` một lần; row lệch chiều (hiếm, dữ liệu cũ)
+    rơi về _cosine min-length như trước.
+    """
+    scores = [0.0] * len(rows)
+    if not rows or query_embedding is None or len(query_embedding) == 0:
+        return scores
+    q = np.asarray(query_embedding, dtype=np.float32)
+    q_norm = math.sqrt(float(np.vdot(q, q)))
+    if q_norm <= 0:
+        return scores
+    qn = q / q_norm
+    dim = q.shape[0]
+    idxs: List[int] = []
+    for i, (_kw_id, _owner_id, _kw_name, emb) in enumerate(rows):
+        if emb is None or len(emb) == 0:
+            continue
+        if len(emb) == dim:
+            idxs.append(i)
+        else:
+            scores[i] = _cosine(query_embedding, emb)
+    if not idxs:
+        return scores
+    # Ma trận stack là float32 C-contiguous nên phép nhân đi thẳng vào kernel
+    # sgemv của BLAS; một kernel JIT riêng (kiểu numba njit/prange) chỉ thắng
+    # thêm khi fuse được cả vòng max-over-query, mà bonus theo từng query part
+    # ở tầng trên không cho phép fuse — nên dừng ở matmul.
+    dots = _stacked_unit_matrix(dim, idxs, rows) @ qn
+    for i, dot in zip(idxs, dots):
+        scores[i] = float(dot)
+    return scores
+
+
+def _cosine_scores_matrix(
+    query_embeddings: List[List[float]],
+    rows: List[Tuple[str, str, str, List[float]]],
+) -> List[List[float]]:
+    """Cosine của K query part với N row trong MỘT lần `E @ Q.T` (sgemm).
+
+    Thay vì K lần matvec qua _cosine_scores_for_rows, stack các query cùng
+    chiều thành ma trận (K,d) và nhân một phát; trả về list điểm theo từng
+    query (cùng thứ tự input). Query/row lệch chiều rơi về đường cũ.
+
+    Không thay bằng simsimd.cdist: simsimd không nằm trong requirements và
+    vector hai phía đã chuẩn hoá sẵn nên cosine = dot — GEMM của BLAS (cũng
+    SIMD, đa luồng) đã là đường nhanh; thêm native dep chỉ đổi kernel này
+    lấy kernel kia.
+    """
+    out: List[List[float]] = [[0.0] * len(rows) for _ in query_embeddings]
+    if not rows or not query_embeddings:
+        return out
+
+    # gom row cùng chiều một lần (dùng lại cache chuẩn hoá như bản matvec)
+    dim_counts: Dict[int, int] = defaultdict(int)
+    for q in query_embeddings:
+        if q is not None and len(q) > 0:
+            dim_counts[len(q)] += 1
+    if not dim_counts:
+        return out
+    dim = max(dim_counts, key=lambda d: dim_counts[d])
+
+    q_idxs: List[int] = []
+    q_vecs: List[np.ndarray] = []
+    for qi, q in enumerate(query_embeddings):
+        if q is None or len(q) != dim:
+            if q is not None and len(q) > 0:
+                out[qi] = _cosine_scores_for_rows(q, rows)
+            continue
+        qv = np.asarray(q, dtype=np.float32)
+        q_norm = math.sqrt(float(np.vdot(qv, qv)))
+        if q_norm <= 0:
+            continue
+        q_idxs.append(qi)
+        q_vecs.append(qv / q_norm)
+    if not q_idxs:
+        return out
+
+    row_idxs: List[int] = []
+    for i, (_kw_id, _owner_id, _kw_name, emb) in enumerate(rows):
+        if emb is None or len(emb) == 0:
+            continue
+        if len(emb) == dim:
+            row_idxs.append(i)
+        else:
+            for qi in q_idxs:
+                out[qi][i] = _cosine(query_embeddings[qi], emb)
+    if not row_idxs:
+        return out
+
+    sims = _stacked_unit_matrix(dim, row_idxs, rows) @ np.asarray(q_vecs, dtype=np.float32).T
+    for col, qi in enumerate(q_idxs):
+        scores = out[qi]
+        for pos, i in enumerate(row_idxs):
+            scores[i] = float(sims[pos, col])
+    return out
 
 
 # kiểm tra và tách lớp / chủ đề / bài / chunk ra khỏi câu hỏi, lấy class bao nhiêu ,......
@@ -283,14 +454,21 @@ def _filter_by_number(rows: List[dict], key: str, number: Optional[int]) -> List
 
 # --------------------------- db helpers ---------------------------
 
+@lru_cache(maxsize=131072)
+def _oid(s: str) -> Optional[ObjectId]:
+    """ObjectId đã parse, memoize theo chuỗi hex.
+
+    Mỗi request validate + parse lại cùng một tập oid (chunk/lesson/topic/
+    subject); tập oid sống là hữu hạn và chuỗi bất biến nên LUT ăn trọn.
+    """
+    # is_valid là check C single-pass, rẻ hơn construct-rồi-bắt-exception
+    if not s or not ObjectId.is_valid(s):
+        return None
+    return ObjectId(s)
+
+
 def _valid_object_id_hex(s: str) -> bool:
-    if not s or len(s) != 24:
-        return False
-    try:
-        int(s, 16)
-        return True
-    except Exception:
-        return False
+    return _oid(s) is not None
 
 
 def _status_visible(doc: dict) -> bool:
@@ -298,6 +476,36 @@ def _status_visible(doc: dict) -> bool:
     return st not in {"hidden", "HIDDEN"}
 
 
+# Chunk hidden trước sau cũng bị builder loại => loại ngay trước khi chấm điểm
+# để khỏi tốn cosine cho item sẽ vứt. Tập hidden nhỏ và đổi chậm nên cache 60s.
+_HIDDEN_CHUNK_TTL = 60.0
+_hidden_chunk_cache: Tuple[float, frozenset] = (0.0, frozenset())
+
+
+def _hidden_chunk_ids(mongo_db, pg: Session) -> frozenset:
+    global _hidden_chunk_cache
+    expires, cached = _hidden_chunk_cache
+    now = time.monotonic()
+    if expires > now:
+        return cached
+    ids: frozenset = frozenset()
+    try:
+        if mongo_db is not None:
+            hidden_hex = [
+                str(doc.get("_id"))
+                for doc in mongo_db["chunks"].find({"status": {"$in": ["hidden", "HIDDEN"]}}, {"_id": 1})
+            ]
+            if hidden_hex:
+                # scalars(): không materialize Row trung gian cho select 1 cột
+                stmt = select(Chunk.chunk_id).where(Chunk.mongo_id.in_(hidden_hex))
+                ids = frozenset(str(v) for v in pg.execute(stmt).scalars() if v)
+    except Exception:
+        # lỗi Mongo/PG => không pre-filter; builder vẫn chặn hidden như cũ
+        return cached
+    _hidden_chunk_cache = (now + _HIDDEN_CHUNK_TTL, ids)
+    return ids
+
+
 def _read_keywords_from_chunk_doc(doc: Optional[dict]) -> List[str]:
     if not doc:
         return []
@@ -319,15 +527,37 @@ def _read_keywords_from_chunk_doc(doc: Optional[dict]) -> List[str]:
     return []
 
 
-def _load_by_oids(mongo_db, col: str, oid_hex_list: List[str]) -> Dict[str, dict]:
+# Chỉ kéo các field mà builder item/media thực sự đọc — doc chunk mang cả nội
+# dung nên fetch full tốn băng thông + BSON decode gấp nhiều lần phần dùng đến.
+_PAGE_DOC_PROJECTIONS = {
+    "chunks": {
+        "chunkName": 1, "chunkType": 1, "chunkUrl": 1, "chunkDescription": 1,
+        "chunkCategory": 1, "status": 1, "createdAt": 1, "updatedAt": 1,
+        "keywordItems": 1, "keywords": 1, "keyword": 1, "keyword_names": 1, "keywordNames": 1,
+    },
+    "lessons": {"lessonDescription": 1, "lesson_description": 1, "description": 1, "lessonType": 1, "lessonUrl": 1, "status": 1},
+    "topics": {"topicDescription": 1, "topic_description": 1, "description": 1, "topicUrl": 1, "status": 1},
+    "subjects": {"subjectDescription": 1, "subjectTitle": 1, "description": 1, "subjectUrl": 1, "status": 1},
+    "images": {"imgName": 1, "imgDescription": 1, "imgUrl": 1, "mapID": 1, "status": 1},
+    "videos": {"videoName": 1, "videoDescription": 1, "videoUrl": 1, "mapID": 1, "status": 1},
+}
+
+
+def _load_by_oids(mongo_db, col: str, oid_hex_list: List[str], *, include_hidden: bool = False) -> Dict[str, dict]:
     out: Dict[str, dict] = {}
     if mongo_db is None or not oid_hex_list:
         return out
     try:
-        oids = [ObjectId(x) for x in oid_hex_list if _valid_object_id_hex(x)]
+        # dedupe trước rồi lấy ObjectId từ memo — khỏi parse lại hex nào đã gặp
+        oids = [o for o in map(_oid, dict.fromkeys(oid_hex_list)) if o is not None]
         if not oids:
             return out
-        for doc in mongo_db[col].find({"_id": {"$in": oids}}):
+        query: dict = {"_id": {"$in": oids}}
+        if not include_hidden:
+            # lọc hidden ngay trên Mongo => doc ẩn không đi qua wire.
+            # CHỈ dùng khi caller coi "ẩn" và "không có doc" như nhau.
+            query["status"] = {"$nin": ["hidden", "HIDDEN"]}
+        for doc in mongo_db[col].find(query, projection=_PAGE_DOC_PROJECTIONS.get(col)):
             out[str(doc.get("_id"))] = doc
     except Exception:
         return out
@@ -340,7 +570,8 @@ def _media_sort_key(x: dict) -> tuple:
 
 
 def _build_media_item(doc: Optional[dict], *, media_type: str, follow_type: str, follow_id: str, pg_id: str) -> Optional[dict]:
-    if not doc or not _status_visible(doc):
+    # doc hidden đã bị lọc ngay từ find ($nin trong _load_by_oids)
+    if not doc:
         return None
     if media_type == "image":
         name = doc.get("imgName") or doc.get("mapID") or pg_id
@@ -509,6 +740,14 @@ def _load_lesson_rows_neo(*, neo, class_id: str, subject_id: str, topic_ids: Opt
         return [], str(exc)
 
 
+# Đồ thị lớp/môn/chủ đề/bài đổi chậm so với tần suất search => memo kết quả
+# chunk-scope theo bộ lọc trong TTL ngắn; cache hit biến cả traversal thành
+# 1 lần tra dict. Không dùng lru_cache vì key chứa list và cần TTL.
+_CHUNK_ROWS_TTL = 60.0
+_CHUNK_ROWS_CACHE_MAX = 128
+_chunk_rows_cache: Dict[Tuple[str, str, Optional[Tuple[str, ...]], Optional[Tuple[str, ...]]], Tuple[float, List[dict]]] = {}
+
+
 def _load_chunk_rows_neo(*, neo, class_id: str, subject_id: str, topic_ids: Optional[List[str]], lesson_ids: Optional[List[str]]) -> Tuple[List[dict], Optional[str]]:
     if neo is None:
         return [], "neo_session_unavailable"
@@ -518,6 +757,16 @@ def _load_chunk_rows_neo(*, neo, class_id: str, subject_id: str, topic_ids: Opti
         return [], None
     if lesson_ids is not None and clean_lesson_ids is not None and not clean_lesson_ids:
         return [], None
+    cache_key = (
+        (class_id or "").strip(),
+        (subject_id or "").strip(),
+        tuple(clean_topic_ids) if clean_topic_ids is not None else None,
+        tuple(clean_lesson_ids) if clean_lesson_ids is not None else None,
+    )
+    now = time.monotonic()
+    hit = _chunk_rows_cache.get(cache_key)
+    if hit is not None and hit[0] > now:
+        return hit[1], None
     try:
         records = neo.run(
             """
@@ -566,6 +815,10 @@ def _load_chunk_rows_neo(*, neo, class_id: str, subject_id: str, topic_ids: Opti
                 "classID": str(r.get("class_id") or "").strip(),
                 "className": str(r.get("class_name") or "").strip(),
             })
+        # chỉ cache kết quả thành công; lỗi Neo để lần sau thử lại
+        if len(_chunk_rows_cache) >= _CHUNK_ROWS_CACHE_MAX:
+            _chunk_rows_cache.clear()
+        _chunk_rows_cache[cache_key] = (now + _CHUNK_ROWS_TTL, rows)
         return rows, None
     except Exception as exc:
         return [], str(exc)
@@ -706,12 +959,21 @@ def _filter_scope_by_name_hint(
     return [str(item["id"]) for item in selected], score_map, debug
 
 
+# Keyword row theo (label, tập owner) chỉ đổi khi sync lại dữ liệu; cùng một
+# scope phổ biến (vd cùng lớp/môn) lặp lại giữa các request => memo 60s loại
+# hẳn round-trip Neo4j cho các lần sau. Vector trong row đi tiếp vào cache
+# chuẩn hoá nên phần scoring không đổi.
+_ENTITY_KW_TTL = 60.0
+_ENTITY_KW_CACHE_MAX = 256
+_entity_kw_cache: Dict[Tuple[str, Tuple[str, ...]], Tuple[float, List[Tuple[str, str, str, np.ndarray]]]] = {}
+
+
 def _load_entity_keyword_rows_from_neo(
     neo,
     *,
     owner_label: str,
     owner_ids: List[str],
-) -> Tuple[List[Tuple[str, str, str, List[float]]], Optional[str]]:
+) -> Tuple[List[Tuple[str, str, str, np.ndarray]], Optional[str]]:
     if neo is None:
         return [], "neo_session_unavailable"
 
@@ -719,18 +981,23 @@ def _load_entity_keyword_rows_from_neo(
     if not clean_owner_ids:
         return [], None
 
+    cache_key = (owner_label, tuple(clean_owner_ids))
+    hit = _entity_kw_cache.get(cache_key)
+    if hit is not None and hit[0] > time.monotonic():
+        return hit[1], None
+
     try:
         cypher = f"""
         UNWIND $owner_ids AS owner_id
         MATCH (owner:{owner_label} {{pg_id: owner_id}})-[:HAS_KEYWORD]->(keyword:Keyword)
-        WHERE keyword.embedding IS NOT NULL
+        WHERE keyword.embedding IS NOT NULL AND size(keyword.embedding) > 0
         RETURN DISTINCT owner.pg_id AS owner_id,
                keyword.pg_id AS keyword_id,
                coalesce(keyword.name, keyword.pg_id) AS keyword_name,
                keyword.embedding AS keyword_embedding
         """
 
-        rows: List[Tuple[str, str, str, List[float]]] = []
+        rows: List[Tuple[str, str, str, np.ndarray]] = []
         for record in neo.run(cypher, owner_ids=clean_owner_ids):
             owner_id = str(record.get("owner_id") or "").strip()
             keyword_id = str(record.get("keyword_id") or "").strip()
@@ -739,14 +1006,19 @@ def _load_entity_keyword_rows_from_neo(
             if not owner_id or not keyword_id or not keyword_name or not embedding:
                 continue
             try:
+                # float32 ndarray ngay từ lúc nạp: không box list Python float
+                # nào đi qua tầng scoring, np.asarray phía sau thành no-op
                 rows.append((
                     keyword_id,
                     owner_id,
                     keyword_name,
-                    [float(x) for x in list(embedding)],
+                    np.asarray(embedding, dtype=np.float32),
                 ))
             except Exception:
                 continue
+        if len(_entity_kw_cache) >= _ENTITY_KW_CACHE_MAX:
+            _entity_kw_cache.clear()
+        _entity_kw_cache[cache_key] = (time.monotonic() + _ENTITY_KW_TTL, rows)
         return rows, None
     except Exception as exc:
         return [], str(exc)
@@ -770,16 +1042,19 @@ def _maybe_expand_with_gemini(query: str, cand_chunks: Optional[List[str]], pg:
     if not terms:
         return [], debug
     try:
-        filtered: List[str] = []
+        if cand_chunks is not None and len(cand_chunks) == 0:
+            return [], debug
+        # N term => N round-trip probe là N+1 kinh điển; gom thành MỘT SELECT
+        # gồm N cột EXISTS để PG plan/chạy tất cả trong 1 lượt
+        probes = []
         for term in terms:
             pat = "%" + term.replace(" ", "%") + "%"
-            stmt = select(Keyword.keyword_id).where(Keyword.keyword_name.ilike(pat)).limit(1)
+            sub = select(Keyword.keyword_id).where(Keyword.keyword_name.ilike(pat))
             if cand_chunks is not None:
-                if len(cand_chunks) == 0:
-                    return [], debug
-                stmt = stmt.where(Keyword.chunk_id.in_(cand_chunks))
-            if bool(list(pg.execute(stmt).all())):
-                filtered.append(term)
+                sub = sub.where(Keyword.chunk_id.in_(cand_chunks))
+            probes.append(exists(sub))
+        hits = pg.execute(select(*probes)).one()
+        filtered = [term for term, hit in zip(terms, hits) if hit]
         debug["after_scope_filter"] = filtered[:]
         return filtered, debug
     except Exception:
@@ -819,6 +1094,7 @@ def _query_embedding_text(raw_query: str, core_query: str, gemini_terms: List[st
     return _norm_spaces(" ".join(_dedupe_keep_order(parts)))
 
 
+@lru_cache(maxsize=16384)
 def _token_overlap_ratio(query_text: str, keyword_name: str) -> float:
     q_tokens = set(_tokens_no_stop(_strip_keyword_filler(query_text or "")))
     k_tokens = set(_tokens_no_stop(_strip_keyword_filler(keyword_name or "")))
@@ -833,8 +1109,9 @@ def _score_keywords_for_query_part(
     rows: List[Tuple[str, str, str, List[float]]],
 ) -> Tuple[List[dict], float]:
     matches: List[dict] = []
-    for keyword_id, chunk_id, keyword_name, keyword_embedding in rows:
-        cosine = _cosine(query_embedding, keyword_embedding)
+    cosines = _cosine_scores_for_rows(query_embedding, rows)
+    for row_idx, (keyword_id, chunk_id, keyword_name, _keyword_embedding) in enumerate(rows):
+        cosine = cosines[row_idx]
         overlap = _token_overlap_ratio(query_text, keyword_name)
         adjusted = float(cosine + 0.06 * overlap)
         matches.append({
@@ -846,16 +1123,15 @@ def _score_keywords_for_query_part(
             "overlap": float(overlap),
             "matchedQueryPart": query_text,
         })
-    matches.sort(key=lambda item: item["score"], reverse=True)
     if not matches:
         return [], 0.0
-    top_score = float(matches[0]["score"])
+    # chỉ cần tối đa 20 item đứng đầu => nlargest O(N log k) thay vì sort full
+    top_matches = heapq.nlargest(20, matches, key=lambda item: item["score"])
+    top_score = float(top_matches[0]["score"])
     min_score = max(0.82, top_score * 0.96)
-    filtered = [item for item in matches if float(item["score"]) >= min_score]
+    filtered = [item for item in top_matches if float(item["score"]) >= min_score]
     if len(filtered) < 5:
-        filtered = matches[: min(8, len(matches))]
-    else:
-        filtered = filtered[:20]
+        filtered = top_matches[: min(8, len(top_matches))]
     return filtered, min_score
 
 
@@ -866,7 +1142,7 @@ def _load_keyword_rows_from_neo(neo, cand_chunks: Optional[List[str]]) -> Tuple[
         records = neo.run(
             """
             MATCH (chunk:Chunk)-[:HAS_KEYWORD]->(keyword:Keyword)
-            WHERE keyword.embedding IS NOT NULL
+            WHERE keyword.embedding IS NOT NULL AND size(keyword.embedding) > 0
               AND keyword.pg_id IS NOT NULL
               AND chunk.pg_id IS NOT NULL
               AND ($cand_chunks IS NULL OR chunk.pg_id IN $cand_chunks)
@@ -895,8 +1171,20 @@ def _load_keyword_rows_from_neo(neo, cand_chunks: Optional[List[str]]) -> Tuple[
 
 
 def _load_keyword_rows_from_pg(pg: Session, cand_chunks: Optional[List[str]]) -> List[Tuple[str, str, str, List[float]]]:
+    # Ranking cosine vẫn nằm ở Python thay vì đẩy xuống pgvector (ORDER BY <=>):
+    # extension không có trong Postgres triển khai, và cột REAL[] còn được
+    # đồng bộ nguyên dạng sang Neo4j. Tập keyword theo scope cỡ nghìn row nên
+    # brute-force qua matmul (xem _cosine_scores_for_rows) vẫn dưới ngưỡng ms.
+    # Lưu ý thêm: hot path của semantic_search đọc keyword row từ Neo4j chứ
+    # không qua hàm này, nên HNSW/<=> phía PG cũng không nằm trên đường nóng.
     try:
-        stmt = select(Keyword.keyword_id, Keyword.chunk_id, Keyword.keyword_name, Keyword.keyword_embedding).where(Keyword.keyword_embedding.isnot(None))
+        # lọc cả embedding rỗng ngay trong WHERE: row vô dụng khỏi đi qua
+        # wire + vòng Python
+        stmt = (
+            select(Keyword.keyword_id, Keyword.chunk_id, Keyword.keyword_name, Keyword.keyword_embedding)
+            .where(Keyword.keyword_embedding.isnot(None))
+            .where(func.array_length(Keyword.keyword_embedding, 1) > 0)
+        )
         if cand_chunks is not None:
             if len(cand_chunks) == 0:
                 return []
@@ -922,6 +1210,7 @@ def _load_keyword_rows_by_map_ids(pg: Session, map_ids: List[str]) -> List[Tuple
         stmt = (
             select(Keyword.keyword_id, Keyword.map_id, Keyword.keyword_name, Keyword.keyword_embedding)
             .where(Keyword.keyword_embedding.isnot(None))
+            .where(func.array_length(Keyword.keyword_embedding, 1) > 0)
             .where(Keyword.map_id.in_(clean_map_ids))
         )
         return [
@@ -941,12 +1230,11 @@ def _score_entity_keyword_rows(
     keep_ratio: Optional[float] = None,
     absolute_floor: Optional[float] = None,
     keep_limit: Optional[int] = None,
+    precomputed_cosines: Optional[List[float]] = None,
 ) -> Tuple[List[str], Dict[str, float], Dict[str, List[Tuple[float, str]]], Dict[str, object]]:
     clean_query = _strip_keyword_filler(query_text or "")
     if not clean_query or not rows:
         return [], {}, {}, {"keyword_rows": len(rows)}
-
-    query_embedding = embed_keyword_cached(clean_query)
     q_tokens = _dedupe_keep_order(_tokens_no_stop(clean_query))
     q_token_set = set(q_tokens)
     token_count = len(q_tokens)
@@ -968,7 +1256,13 @@ def _score_entity_keyword_rows(
     owner_phrase_hits: Dict[str, int] = defaultdict(int)
     owner_exact_or_phrase: Dict[str, bool] = defaultdict(bool)
 
-    for keyword_id, owner_id, keyword_name, keyword_embedding in rows:
+    # multi-part đã tính sẵn cosine cho mọi part bằng 1 GEMM => nhận lại cột
+    # của part này thay vì matvec lại
+    if precomputed_cosines is not None and len(precomputed_cosines) == len(rows):
+        cosines = precomputed_cosines
+    else:
+        cosines = _cosine_scores_for_rows(embed_keyword_cached(clean_query), rows)
+    for row_idx, (keyword_id, owner_id, keyword_name, _keyword_embedding) in enumerate(rows):
         owner_key = (owner_alias_by_id or {}).get(owner_id) or _entity_alias_key(owner_id) or owner_id
         if not owner_key:
             continue
@@ -976,7 +1270,7 @@ def _score_entity_keyword_rows(
         if owner_id not in owner_ids:
             owner_ids.append(owner_id)
 
-        cosine = _cosine(query_embedding, keyword_embedding)
+        cosine = cosines[row_idx]
         overlap = _token_overlap_ratio(clean_query, keyword_name)
         norm_kw = _norm_keyword_text(keyword_name)
         kw_tokens = set(_tokens_no_stop(keyword_name or ""))
@@ -1139,6 +1433,16 @@ def _score_entity_keyword_rows_multi(
         debug["multi_mode"] = False
         return matched_aliases, score_by_owner, matched_keywords, debug
 
+    # embed mọi part trong 1 lần gọi provider rồi chấm cosine cho cả
+    # K part x N row bằng một GEMM duy nhất; từng part chỉ còn cộng bonus
+    cosines_by_part: Dict[str, List[float]] = {}
+    try:
+        part_embeddings = embed_keywords_batch(clean_parts)
+        cosines_matrix = _cosine_scores_matrix(part_embeddings, rows)
+        cosines_by_part = dict(zip(clean_parts, cosines_matrix))
+    except Exception:
+        pass
+
     combined_scores: Dict[str, float] = {}
     combined_keywords: Dict[str, List[Tuple[float, str]]] = {}
     matched_parts_by_alias: Dict[str, List[str]] = defaultdict(list)
@@ -1154,6 +1458,7 @@ def _score_entity_keyword_rows_multi(
             keep_ratio=keep_ratio,
             absolute_floor=absolute_floor,
             keep_limit=part_keep_limit,
+            precomputed_cosines=cosines_by_part.get(part),
         )
         part_debugs.append({
             "query_part": part,
@@ -1238,24 +1543,24 @@ def _exact_keyword_hits(keyword_query: str, rows: List[Tuple[str, str, str, List
 
 def _score_keywords(query_embedding: List[float], rows: List[Tuple[str, str, str, List[float]]]) -> Tuple[List[dict], float]:
     matches: List[dict] = []
-    for keyword_id, chunk_id, keyword_name, keyword_embedding in rows:
-        score = _cosine(query_embedding, keyword_embedding)
+    scores = _cosine_scores_for_rows(query_embedding, rows)
+    for row_idx, (keyword_id, chunk_id, keyword_name, _keyword_embedding) in enumerate(rows):
+        score = scores[row_idx]
         matches.append({
             "keywordID": keyword_id,
             "chunkID": chunk_id,
             "keywordName": keyword_name,
             "score": float(score),
         })
-    matches.sort(key=lambda item: item["score"], reverse=True)
     if not matches:
         return [], 0.0
-    top_score = float(matches[0]["score"])
+    # chỉ cần tối đa 20 item đứng đầu => nlargest O(N log k) thay vì sort full
+    top_matches = heapq.nlargest(20, matches, key=lambda item: item["score"])
+    top_score = float(top_matches[0]["score"])
     min_score = max(0.82, top_score * 0.96)
-    filtered = [item for item in matches if float(item["score"]) >= min_score]
+    filtered = [item for item in top_matches if float(item["score"]) >= min_score]
     if len(filtered) < 5:
-        filtered = matches[: min(8, len(matches))]
-    else:
-        filtered = filtered[:20]
+        filtered = top_matches[: min(8, len(top_matches))]
     return filtered, min_score
 
 
@@ -1410,51 +1715,129 @@ def _neo_hierarchy_for_chunks(neo, chunk_ids: List[str]) -> Tuple[Dict[str, dict
         return {}, str(exc)
 
 
-def _load_pg_page_rows(pg: Session, chunk_ids: List[str]) -> Dict[str, dict]:
+@dataclass(slots=True)
+class PgPageRow:
+    """Metadata PG phẳng cho 1 chunk của trang kết quả.
+
+    Slotted dataclass thay cho dict lồng dict: mỗi truy cập là 1 attribute
+    load thay vì 2 lần dò hash, footprint mỗi row nhỏ hơn hẳn khi trang lớn
+    (cùng lý do với ChainDocs bên postgre_sync_from_mongo).
+    """
+    chunk_id: str = ""
+    chunk_name: Optional[str] = None
+    chunk_type: Optional[str] = None
+    chunk_number: Optional[int] = None
+    chunk_mongo_id: Optional[str] = None
+    lesson_id: Optional[str] = None
+    lesson_name: Optional[str] = None
+    lesson_number: Optional[int] = None
+    lesson_mongo_id: Optional[str] = None
+    topic_id: Optional[str] = None
+    topic_name: Optional[str] = None
+    topic_number: Optional[int] = None
+    topic_mongo_id: Optional[str] = None
+    subject_id: Optional[str] = None
+    subject_name: Optional[str] = None
+    subject_mongo_id: Optional[str] = None
+    class_id: Optional[str] = None
+    class_name: Optional[str] = None
+    class_mongo_id: Optional[str] = None
+
+
+# row rỗng dùng chung khi chunk không có metadata PG (item vẫn build từ Neo)
+_EMPTY_PG_ROW = PgPageRow()
+
+# Hierarchy PG đổi rất chậm so với tần suất search => memo từng row theo
+# chunk_id với TTL; trang lặp lại (hoặc chồng lấn) chỉ query phần id thiếu.
+# Không dùng background refresh/NOTIFY vì repo chưa có hạ tầng task nền —
+# TTL ngắn là đủ để tên mới sau sync xuất hiện.
+_PG_ROW_TTL = 300.0
+_PG_ROW_CACHE_MAX = 20_000
+_pg_row_cache: Dict[str, Tuple[float, PgPageRow]] = {}
+
+
+def _load_pg_page_rows(pg: Session, chunk_ids: List[str]) -> Tuple[Dict[str, PgPageRow], Dict[str, List[str]]]:
+    """Nạp metadata PG cho trang; trả kèm mongo_id hợp lệ theo collection.
+
+    Gom hex id ngay trong vòng duyệt row thay vì để builder quét lại
+    pg_map.values() lần nữa — một pass thay vì hai trên cùng dữ liệu.
+
+    Không denormalize tên hierarchy vào doc chunk Mongo để bỏ query này:
+    tên lesson/topic/subject đã về trong CÙNG round-trip Neo4j của
+    _neo_hierarchy_for_chunks (pg_map chỉ là fallback + nguồn mongo_id),
+    còn denormalize nghĩa là mọi lần đổi tên phải fan-out update cả
+    collection chunks — đổi 1 query đọc lấy một invariant ghi đắt hơn.
+    """
+    mongo_hex: Dict[str, List[str]] = {"chunks": [], "lessons": [], "topics": [], "subjects": []}
     if not chunk_ids:
-        return {}
-    try:
-        stmt = (
-            select(
-                Chunk.chunk_id,
-                Chunk.chunk_name,
-                Chunk.chunk_type,
-                Chunk.chunk_number,
-                Chunk.mongo_id,
-                Lesson.lesson_id,
-                Lesson.lesson_name,
-                Lesson.lesson_number,
-                Lesson.mongo_id,
-                Topic.topic_id,
-                Topic.topic_name,
-                Topic.topic_number,
-                Topic.mongo_id,
-                Subject.subject_id,
-                Subject.subject_name,
-                Subject.mongo_id,
-                Class.class_id,
-                Class.class_name,
-                Class.mongo_id,
+        return {}, mongo_hex
+    now = time.monotonic()
+    out: Dict[str, PgPageRow] = {}
+    missing: List[str] = []
+    for cid in chunk_ids:
+        hit = _pg_row_cache.get(cid)
+        if hit is not None and hit[0] > now:
+            out[cid] = hit[1]
+        else:
+            missing.append(cid)
+    if missing:
+        try:
+            stmt = (
+                select(
+                    Chunk.chunk_id,
+                    Chunk.chunk_name,
+                    Chunk.chunk_type,
+                    Chunk.chunk_number,
+                    Chunk.mongo_id,
+                    Lesson.lesson_id,
+                    Lesson.lesson_name,
+                    Lesson.lesson_number,
+                    Lesson.mongo_id,
+                    Topic.topic_id,
+                    Topic.topic_name,
+                    Topic.topic_number,
+                    Topic.mongo_id,
+                    Subject.subject_id,
+                    Subject.subject_name,
+                    Subject.mongo_id,
+                    Class.class_id,
+                    Class.class_name,
+                    Class.mongo_id,
+                )
+                .join(Lesson, Lesson.lesson_id == Chunk.lesson_id)
+                .join(Topic, Topic.topic_id == Lesson.topic_id)
+                .join(Subject, Subject.subject_id == Topic.subject_id)
+                .join(Class, Class.class_id == Subject.class_id)
+                .where(Chunk.chunk_id.in_(missing))
             )
-            .join(Lesson, Lesson.lesson_id == Chunk.lesson_id)
-            .join(Topic, Topic.topic_id == Lesson.topic_id)
-            .join(Subject, Subject.subject_id == Topic.subject_id)
-            .join(Class, Class.class_id == Subject.class_id)
-            .where(Chunk.chunk_id.in_(chunk_ids))
-        )
-        rows = list(pg.execute(stmt).all())
-    except SQLAlchemyError:
-        return {}
-    out: Dict[str, dict] = {}
-    for r in rows:
-        out[str(r[0])] = {
-            "chunkID": str(r[0]), "chunkName": r[1], "chunkType": r[2], "chunkNumber": r[3], "chunkMongoId": r[4],
-            "lesson": {"lessonID": r[5], "lessonName": r[6], "lessonNumber": r[7], "mongoId": r[8]},
-            "topic": {"topicID": r[9], "topicName": r[10], "topicNumber": r[11], "mongoId": r[12]},
-            "subject": {"subjectID": r[13], "subjectName": r[14], "mongoId": r[15]},
-            "class": {"classID": r[16], "className": r[17], "mongoId": r[18]},
-        }
-    return out
+            # duyệt thẳng result, không copy sang list trung gian; mỗi chunk
+            # chỉ giữ đúng 1 row phẳng (các dict pg_lessons/pg_topics/...
+            # per-level đã bị JOIN gộp từ trước)
+            for r in pg.execute(stmt):
+                row = PgPageRow(
+                    chunk_id=str(r[0]), chunk_name=r[1], chunk_type=r[2], chunk_number=r[3], chunk_mongo_id=r[4],
+                    lesson_id=r[5], lesson_name=r[6], lesson_number=r[7], lesson_mongo_id=r[8],
+                    topic_id=r[9], topic_name=r[10], topic_number=r[11], topic_mongo_id=r[12],
+                    subject_id=r[13], subject_name=r[14], subject_mongo_id=r[15],
+                    class_id=r[16], class_name=r[17], class_mongo_id=r[18],
+                )
+                out[row.chunk_id] = row
+                if len(_pg_row_cache) >= _PG_ROW_CACHE_MAX:
+                    _pg_row_cache.clear()
+                _pg_row_cache[row.chunk_id] = (now + _PG_ROW_TTL, row)
+        except SQLAlchemyError:
+            # phần cache hit vẫn dùng được; chỉ mất các row chưa fetch
+            pass
+    for row in out.values():
+        if _valid_object_id_hex(row.chunk_mongo_id or ""):
+            mongo_hex["chunks"].append(row.chunk_mongo_id)
+        if _valid_object_id_hex(row.lesson_mongo_id or ""):
+            mongo_hex["lessons"].append(row.lesson_mongo_id)
+        if _valid_object_id_hex(row.topic_mongo_id or ""):
+            mongo_hex["topics"].append(row.topic_mongo_id)
+        if _valid_object_id_hex(row.subject_mongo_id or ""):
+            mongo_hex["subjects"].append(row.subject_mongo_id)
+    return out, mongo_hex
 
 
 # --------------------------- response builders ---------------------------
@@ -1509,44 +1892,92 @@ def _build_chunk_items(
     page_chunk_ids: List[str],
     score_by_chunk: Dict[str, float],
     chunk_top_kw: Dict[str, List[Tuple[float, str]]],
-    pg_map: Dict[str, dict],
+    pg_map: Dict[str, PgPageRow],
     neo_map: Dict[str, dict],
     mongo_db,
     category: str,
     username: str,
     pg: Session,
     dbg: Dict[str, object],
-) -> List[dict]:
-    chunk_mongo_hex: List[str] = []
-    lesson_mongo_hex: List[str] = []
-    topic_mongo_hex: List[str] = []
-    subject_mongo_hex: List[str] = []
-    for base in pg_map.values():
-        if _valid_object_id_hex(base.get("chunkMongoId") or ""):
-            chunk_mongo_hex.append(base["chunkMongoId"])
-        if _valid_object_id_hex((base.get("lesson") or {}).get("mongoId") or ""):
-            lesson_mongo_hex.append(base["lesson"]["mongoId"])
-        if _valid_object_id_hex((base.get("topic") or {}).get("mongoId") or ""):
-            topic_mongo_hex.append(base["topic"]["mongoId"])
-        if _valid_object_id_hex((base.get("subject") or {}).get("mongoId") or ""):
-            subject_mongo_hex.append(base["subject"]["mongoId"])
-    mongo_chunks_by_oid = _load_by_oids(mongo_db, "chunks", chunk_mongo_hex)
-    mongo_lessons_by_oid = _load_by_oids(mongo_db, "lessons", lesson_mongo_hex)
-    mongo_topics_by_oid = _load_by_oids(mongo_db, "topics", topic_mongo_hex)
-    mongo_subjects_by_oid = _load_by_oids(mongo_db, "subjects", subject_mongo_hex)
+    offset: int = 0,
+    limit: Optional[int] = None,
+    mongo_hex_by_col: Optional[Dict[str, List[str]]] = None,
+) -> Tuple[List[dict], int]:
+    """Build item dict cho trang kết quả; trả (items, tổng item hợp lệ).
+
+    Pha 1 chỉ chạy kiểm tra hiển thị (rẻ) trên toàn bộ id để đếm total;
+    pha 2 mới dựng dict đầy đủ — và chỉ cho lát [offset:offset+limit] khi
+    có limit, thay vì materialize cả danh sách rồi vứt gần hết.
+    """
+    # hex id thường được _load_pg_page_rows gom sẵn trong cùng pass dựng
+    # pg_map; chỉ quét lại khi caller không đưa
+    if mongo_hex_by_col is not None:
+        chunk_mongo_hex = mongo_hex_by_col.get("chunks") or []
+        lesson_mongo_hex = mongo_hex_by_col.get("lessons") or []
+        topic_mongo_hex = mongo_hex_by_col.get("topics") or []
+        subject_mongo_hex = mongo_hex_by_col.get("subjects") or []
+    else:
+        chunk_mongo_hex = []
+        lesson_mongo_hex = []
+        topic_mongo_hex = []
+        subject_mongo_hex = []
+        for base in pg_map.values():
+            if _valid_object_id_hex(base.chunk_mongo_id or ""):
+                chunk_mongo_hex.append(base.chunk_mongo_id)
+            if _valid_object_id_hex(base.lesson_mongo_id or ""):
+                lesson_mongo_hex.append(base.lesson_mongo_id)
+            if _valid_object_id_hex(base.topic_mongo_id or ""):
+                topic_mongo_hex.append(base.topic_mongo_id)
+            if _valid_object_id_hex(base.subject_mongo_id or ""):
+                subject_mongo_hex.append(base.subject_mongo_id)
+    # isSaved cho cả trang bằng 1 query $in + membership set thay vì
+    # find_one từng item (N RTT Mongo mỗi trang)
+    def _load_saved_chunk_ids() -> set[str]:
+        try:
+            if mongo_db is None or not username or not page_chunk_ids:
+                return set()
+            return {
+                str(doc.get("chunkID") or "")
+                for doc in mongo_db["user_saved_chunks"].find(
+                    {"username": username, "chunkID": {"$in": list(page_chunk_ids)}},
+                    {"chunkID": 1, "_id": 0},
+                )
+            }
+        except Exception:
+            return set()
+
+    # 5 query độc lập => bắn song song thay vì tuần tự (MongoClient
+    # thread-safe, mỗi query vẫn là 1 RTT $in cho cả trang)
+    # include_hidden=True: builder phải PHÂN BIỆT doc ẩn (chặn cả item, ghi
+    # blocked_hidden) với doc không tồn tại (item vẫn build từ PG/Neo) nên
+    # không đẩy $nin xuống Mongo ở đây được
+    with ThreadPoolExecutor(max_workers=5) as pool:
+        chunks_future = pool.submit(_load_by_oids, mongo_db, "chunks", chunk_mongo_hex, include_hidden=True)
+        lessons_future = pool.submit(_load_by_oids, mongo_db, "lessons", lesson_mongo_hex, include_hidden=True)
+        topics_future = pool.submit(_load_by_oids, mongo_db, "topics", topic_mongo_hex, include_hidden=True)
+        subjects_future = pool.submit(_load_by_oids, mongo_db, "subjects", subject_mongo_hex, include_hidden=True)
+        saved_future = pool.submit(_load_saved_chunk_ids)
+        mongo_chunks_by_oid = chunks_future.result()
+        mongo_lessons_by_oid = lessons_future.result()
+        mongo_topics_by_oid = topics_future.result()
+        mongo_subjects_by_oid = subjects_future.result()
+        saved_chunk_ids = saved_future.result()
 
     dbg["media_hit_groups"] = sum(1 for payload in neo_map.values() if (payload.get("images") or payload.get("videos")))
 
-    items: List[dict] = []
+    # Pha 1: lọc hiển thị, giữ lại doc đã tra để pha 2 khỏi tra lại
+    visible: List[Tuple[str, dict, PgPageRow, Optional[dict], Optional[dict], Optional[dict], Optional[dict]]] = []
     for chunk_id in page_chunk_ids:
         neo_base = neo_map.get(chunk_id) or {}
-        pg_base = pg_map.get(chunk_id) or {}
-        if not neo_base and not pg_base:
+        pg_base = pg_map.get(chunk_id)
+        if not neo_base and pg_base is None:
             continue
+        if pg_base is None:
+            pg_base = _EMPTY_PG_ROW
 
         chunk_doc = None
-        if _valid_object_id_hex(pg_base.get("chunkMongoId") or ""):
-            chunk_doc = mongo_chunks_by_oid.get(pg_base["chunkMongoId"])
+        if _valid_object_id_hex(pg_base.chunk_mongo_id or ""):
+            chunk_doc = mongo_chunks_by_oid.get(pg_base.chunk_mongo_id)
         if chunk_doc and not _status_visible(chunk_doc):
             dbg.setdefault("item_build", {}).setdefault("blocked_hidden", []).append({"chunkID": chunk_id, "reason": "chunk_hidden"})
             continue
@@ -1555,9 +1986,9 @@ def _build_chunk_items(
             if chunk_category and chunk_category != category:
                 dbg.setdefault("item_build", {}).setdefault("non_blocking_flags", []).append({"chunkID": chunk_id, "reason": "mongo_category_mismatch", "mongo_category": chunk_category})
 
-        lesson_oid = (pg_base.get("lesson") or {}).get("mongoId") or ""
-        topic_oid = (pg_base.get("topic") or {}).get("mongoId") or ""
-        subject_oid = (pg_base.get("subject") or {}).get("mongoId") or ""
+        lesson_oid = pg_base.lesson_mongo_id or ""
+        topic_oid = pg_base.topic_mongo_id or ""
+        subject_oid = pg_base.subject_mongo_id or ""
         lesson_doc = mongo_lessons_by_oid.get(lesson_oid) if _valid_object_id_hex(lesson_oid) else None
         topic_doc = mongo_topics_by_oid.get(topic_oid) if _valid_object_id_hex(topic_oid) else None
         subject_doc = mongo_subjects_by_oid.get(subject_oid) if _valid_object_id_hex(subject_oid) else None
@@ -1572,14 +2003,22 @@ def _build_chunk_items(
             dbg.setdefault("item_build", {}).setdefault("blocked_hidden", []).append({"chunkID": chunk_id, "reason": "subject_hidden"})
             continue
 
-        lesson_name = (neo_base.get("lesson") or {}).get("lessonName") or (pg_base.get("lesson") or {}).get("lessonName") or ""
-        topic_name = (neo_base.get("topic") or {}).get("topicName") or (pg_base.get("topic") or {}).get("topicName") or ""
-        subject_name = (neo_base.get("subject") or {}).get("subjectName") or (pg_base.get("subject") or {}).get("subjectName") or ""
-        class_name = (neo_base.get("class") or {}).get("className") or (pg_base.get("class") or {}).get("className") or ""
-        lesson_id_v = (neo_base.get("lesson") or {}).get("lessonID") or (pg_base.get("lesson") or {}).get("lessonID") or ""
-        topic_id_v = (neo_base.get("topic") or {}).get("topicID") or (pg_base.get("topic") or {}).get("topicID") or ""
-        subject_id_v = (neo_base.get("subject") or {}).get("subjectID") or (pg_base.get("subject") or {}).get("subjectID") or ""
-        class_id_v = (neo_base.get("class") or {}).get("classID") or (pg_base.get("class") or {}).get("classID") or ""
+        visible.append((chunk_id, neo_base, pg_base, chunk_doc, lesson_doc, topic_doc, subject_doc))
+
+    total = len(visible)
+    page = visible if limit is None else visible[offset : offset + limit]
+
+    # Pha 2: dựng dict đầy đủ chỉ cho lát được trả về
+    items: List[dict] = []
+    for chunk_id, neo_base, pg_base, chunk_doc, lesson_doc, topic_doc, subject_doc in page:
+        lesson_name = (neo_base.get("lesson") or {}).get("lessonName") or pg_base.lesson_name or ""
+        topic_name = (neo_base.get("topic") or {}).get("topicName") or pg_base.topic_name or ""
+        subject_name = (neo_base.get("subject") or {}).get("subjectName") or pg_base.subject_name or ""
+        class_name = (neo_base.get("class") or {}).get("className") or pg_base.class_name or ""
+        lesson_id_v = (neo_base.get("lesson") or {}).get("lessonID") or pg_base.lesson_id or ""
+        topic_id_v = (neo_base.get("topic") or {}).get("topicID") or pg_base.topic_id or ""
+        subject_id_v = (neo_base.get("subject") or {}).get("subjectID") or pg_base.subject_id or ""
+        class_id_v = (neo_base.get("class") or {}).get("classID") or pg_base.class_id or ""
 
         images: List[dict] = list(neo_base.get("images") or [])
         videos: List[dict] = list(neo_base.get("videos") or [])
@@ -1593,12 +2032,12 @@ def _build_chunk_items(
         item = {
             "type": "chunk",
             "id": chunk_id,
-            "name": (neo_base.get("chunkName") or pg_base.get("chunkName") or (chunk_doc or {}).get("chunkName") or chunk_id),
+            "name": (neo_base.get("chunkName") or pg_base.chunk_name or (chunk_doc or {}).get("chunkName") or chunk_id),
             "score": float(score_by_chunk.get(chunk_id, 0.0)),
             "chunkID": chunk_id,
-            "chunkName": (chunk_doc.get("chunkName") if chunk_doc else None) or neo_base.get("chunkName") or pg_base.get("chunkName") or chunk_id,
-            "chunkType": (chunk_doc.get("chunkType") if chunk_doc else None) or pg_base.get("chunkType"),
-            "chunkNumber": neo_base.get("chunkNumber") if neo_base.get("chunkNumber") is not None else pg_base.get("chunkNumber"),
+            "chunkName": (chunk_doc.get("chunkName") if chunk_doc else None) or neo_base.get("chunkName") or pg_base.chunk_name or chunk_id,
+            "chunkType": (chunk_doc.get("chunkType") if chunk_doc else None) or pg_base.chunk_type,
+            "chunkNumber": neo_base.get("chunkNumber") if neo_base.get("chunkNumber") is not None else pg_base.chunk_number,
             "chunkUrl": (chunk_doc.get("chunkUrl") if chunk_doc else None),
             "chunkDescription": (chunk_doc.get("chunkDescription") if chunk_doc else None),
             "createdAt": (chunk_doc.get("createdAt") if chunk_doc else None),
@@ -1608,7 +2047,7 @@ def _build_chunk_items(
             "images": images,
             "videos": videos,
             "mediaSummary": media_summary,
-            "isSaved": False,
+            "isSaved": chunk_id in saved_chunk_ids,
             "class": {"classID": class_id_v, "className": class_name},
             "subject": {
                 "subjectID": subject_id_v,
@@ -1619,28 +2058,22 @@ def _build_chunk_items(
             "topic": {
                 "topicID": topic_id_v,
                 "topicName": topic_name,
-                "topicNumber": (neo_base.get("topic") or {}).get("topicNumber") if (neo_base.get("topic") or {}).get("topicNumber") is not None else (pg_base.get("topic") or {}).get("topicNumber"),
+                "topicNumber": (neo_base.get("topic") or {}).get("topicNumber") if (neo_base.get("topic") or {}).get("topicNumber") is not None else pg_base.topic_number,
                 "topicDescription": ((topic_doc.get("topicDescription") if topic_doc else None) or (topic_doc.get("topic_description") if topic_doc else None) or (topic_doc.get("description") if topic_doc else None) or ""),
                 "topicUrl": (topic_doc.get("topicUrl") if topic_doc and _status_visible(topic_doc) else ""),
             },
             "lesson": {
                 "lessonID": lesson_id_v,
                 "lessonName": lesson_name,
-                "lessonNumber": (neo_base.get("lesson") or {}).get("lessonNumber") if (neo_base.get("lesson") or {}).get("lessonNumber") is not None else (pg_base.get("lesson") or {}).get("lessonNumber"),
+                "lessonNumber": (neo_base.get("lesson") or {}).get("lessonNumber") if (neo_base.get("lesson") or {}).get("lessonNumber") is not None else pg_base.lesson_number,
                 "lessonDescription": ((lesson_doc.get("lessonDescription") if lesson_doc else None) or (lesson_doc.get("lesson_description") if lesson_doc else None) or (lesson_doc.get("description") if lesson_doc else None) or (lesson_doc.get("lessonType") if lesson_doc else None) or ""),
                 "lessonUrl": (lesson_doc.get("lessonUrl") if lesson_doc and _status_visible(lesson_doc) else ""),
                 "lessonType": (lesson_doc.get("lessonType") if lesson_doc else None) or "",
             },
             "category": (chunk_doc.get("chunkCategory") if chunk_doc else None) or category or "document",
         }
-        try:
-            if mongo_db is not None:
-                saved = mongo_db["user_saved_chunks"].find_one({"username": username, "chunkID": chunk_id})
-                item["isSaved"] = bool(saved)
-        except Exception:
-            pass
         items.append(item)
-    return items
+    return items, total
 
 
 def _pick_return_mode(ctx: dict, *, topicID: str, lessonID: str) -> str:
@@ -1791,8 +2224,8 @@ def semantic_search(
             neo_map, neo_error = _neo_hierarchy_for_chunks(neo, page_chunk_ids)
             if neo_error:
                 dbg["neo_error"] = neo_error
-            pg_map = _load_pg_page_rows(pg, page_chunk_ids)
-            items = _build_chunk_items(
+            pg_map, mongo_hex_by_col = _load_pg_page_rows(pg, page_chunk_ids)
+            items, _ = _build_chunk_items(
                 page_chunk_ids=page_chunk_ids,
                 score_by_chunk=score_by_chunk,
                 chunk_top_kw=chunk_top_kw,
@@ -1803,6 +2236,7 @@ def semantic_search(
                 username=username,
                 pg=pg,
                 dbg=dbg,
+                mongo_hex_by_col=mongo_hex_by_col,
             )
             res = {"total": len(items), "items": items}
             if debug:
@@ -1986,6 +2420,14 @@ def semantic_search(
     )
 
     # Chunk gate
+    hidden_chunk_ids = _hidden_chunk_ids(mongo_db, pg)
+    if hidden_chunk_ids:
+        before_hidden = len(filtered_chunk_rows)
+        filtered_chunk_rows = [
+            row for row in filtered_chunk_rows
+            if str(row.get("chunkID") or "") not in hidden_chunk_ids
+        ]
+        dbg["hidden_prefiltered"] = before_hidden - len(filtered_chunk_rows)
     chunk_ids = _collect_ids_keep_case(filtered_chunk_rows, "chunkID")
     chunk_alias_by_id, chunk_ids_by_alias = _alias_map_for_rows(filtered_chunk_rows, id_key="chunkID", name_key="chunkName")
     dbg["candidate_chunk_scope"] = len(chunk_ids)
@@ -2031,6 +2473,9 @@ def semantic_search(
             res["debug"] = dbg
         return _finalize_result(res)
 
+    # Sort đủ chứ không heapq.nlargest top-k: toàn bộ danh sách ranked đều
+    # được tiêu thụ (đếm total hợp lệ + phân trang theo offset bất kỳ), và
+    # kích thước đã bị chặn từ trước bởi keep_limit của chunk gate.
     ranked_chunks = sorted(
         [
             (
@@ -2057,10 +2502,10 @@ def semantic_search(
     if neo_error:
         dbg["neo_error"] = neo_error
     dbg["hierarchy_source"] = "neo4j" if neo_map else "postgresql"
-    pg_map = _load_pg_page_rows(pg, all_ranked_chunk_ids)
+    pg_map, mongo_hex_by_col = _load_pg_page_rows(pg, all_ranked_chunk_ids)
     dbg["pg_chunk_rows"] = len(pg_map)
 
-    all_items = _build_chunk_items(
+    items, total = _build_chunk_items(
         page_chunk_ids=all_ranked_chunk_ids,
         score_by_chunk=score_by_chunk,
         chunk_top_kw=chunk_kw,
@@ -2071,13 +2516,15 @@ def semantic_search(
         username=username,
         pg=pg,
         dbg=dbg,
+        offset=offset,
+        limit=limit,
+        mongo_hex_by_col=mongo_hex_by_col,
     )
 
-
-    items = all_items[offset : offset + limit]
-    res = {"total": len(all_items), "items": items}
+    res = {"total": total, "items": items}
     if debug:
-        dbg["items_built"] = len(all_items)
+        dbg["items_built"] = len(items)
+        dbg["items_visible_total"] = total
         if items:
             dbg["sample_item_match"] = {
                 "chunkID": items[0].get("chunkID"),
@@ -0,0 +1,10 @@
+-- Covering indexes for the mongo_id equality lookups done by the PG sync.
+-- INCLUDE the PK column so "SELECT pk FROM t WHERE mongo_id = ..." can run
+-- as an index-only scan (no heap fetch).
+-- Safe to run any time; the app also creates these lazily on startup.
+
+CREATE INDEX IF NOT EXISTS idx_class_mongo_id   ON class(mongo_id)   INCLUDE (class_id);
+CREATE INDEX IF NOT EXISTS idx_subject_mongo_id ON subject(mongo_id) INCLUDE (subject_id);
+CREATE INDEX IF NOT EXISTS idx_topic_mongo_id   ON topic(mongo_id)   INCLUDE (topic_id);
+CREATE INDEX IF NOT EXISTS idx_lesson_mongo_id  ON lesson(mongo_id)  INCLUDE (lesson_id);
+CREATE INDEX IF NOT EXISTS idx_chunk_mongo_id   ON chunk(mongo_id)   INCLUDE (chunk_id, content_hash);